@@ -4,37 +4,47 @@
 import sys
 import getopt
 
+from libaml import apk
 from libaml.aml import AML
-from libaml.aml import ResTypes
+from libaml.selector import Selector
 
 
 """
 This example demonstrates the how to modify binary XML using libaml.
 It parses AndroidManifest.xml and increases version code by one.
+Given an APK, only the manifest entry is rewritten and every other entry is copied as it is.
 """
 
+
+VERSION_CODE = Selector('manifest[@android:versionCode]')
+
+
+def increaseversioncode(buf):
+    # Bumping the version code doesn't change the document size, so it is patched in place.
+    for manifest in VERSION_CODE.iterselect(AML(buf, readonly=True)):
+        versioncode = manifest.getattribute('versionCode')
+        if versioncode is not None:
+            versioncode.patch(versioncode.typedValue.data + 1)
+        break
+
+
 if __name__ == '__main__':
     opts, args = getopt.getopt(sys.argv[1:], 'i:o:')
     params = dict([(i.lstrip('-'), j) for i, j in opts])
 
     if 'i' not in params:
-        print('Usage:\n%s -i AndroidManifest.xml [-o outfile.xml]' % sys.argv[0])
+        print('Usage:\n%s -i AndroidManifest.xml|app.apk [-o outfile]' % sys.argv[0])
         sys.exit(0)
 
     infile = params['i']
     outfile = params['o'] if 'o' in params else infile
 
-    with open(infile, 'rb') as fp:
-        buf = fp.read()
-
-    aml = AML(buf)
-    while aml.hasnext():
-        header, body = aml.next()
-        if header.type == ResTypes.RES_XML_START_ELEMENT_TYPE and body.nodename == 'manifest':
-            for i in body.attributes:
-                if str(i) == 'android:versionCode':
-                    i.typedValue.data += 1
-
-    with open(outfile, 'wb') as fp:
-        fp.write(aml.tobytes())
+    if infile.endswith('.apk'):
+        apk.rewriteentry(infile, outfile, increaseversioncode)
+    else:
+        with open(infile, 'rb') as fp:
+            buf = bytearray(fp.read())
+        increaseversioncode(buf)
+        with open(outfile, 'wb') as fp:
+            fp.write(buf)
     print('Done.')
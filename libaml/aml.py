@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import array
+import collections.abc
+import contextlib
 import ctypes
+import itertools
+import mmap
+import os
 import struct
 import pkgutil
 
@@ -11,27 +17,45 @@ from .utils.decorator import Struct
 class ByteArrayBuffer:
     def __init__(self):
         self._buffers = []
+        self._objects = []
+        self._bytessize = 0
 
     @property
     def size(self):
-        return sum([i.size for i in self._buffers])
+        return self._bytessize + sum([i.size for i in self._objects])
 
     def append(self, data):
-        class ByBytes:
-            def __init__(self, bytesbuf):
-                self._bytesbuf = bytesbuf
-
-            @property
-            def size(self):
-                return len(self._bytesbuf)
-
-            def tobytes(self):
-                return self._bytesbuf
-
-        self._buffers.append(ByBytes(data) if type(data) is bytes else data)
+        if isinstance(data, (bytes, memoryview)):
+            self._bytessize += len(data)
+        else:
+            self._objects.append(data)
+        self._buffers.append(data)
+
+    def iterchunks(self):
+        for i in self._buffers:
+            if isinstance(i, (bytes, memoryview)):
+                yield i
+            elif hasattr(i, 'iterchunks'):
+                for j in i.iterchunks():
+                    yield j
+            else:
+                yield i.tobytes()
+
+    def iterreferences(self):
+        for i in self._objects:
+            if hasattr(i, 'iterreferences'):
+                for j in i.iterreferences():
+                    yield j
+
+    def writeto(self, fp):
+        size = 0
+        for i in self.iterchunks():
+            fp.write(i)
+            size += len(i)
+        return size
 
     def tobytes(self):
-        return b''.join([i.tobytes() for i in self._buffers])
+        return b''.join(self.iterchunks())
 
 
 class ResTypes:
@@ -52,22 +76,52 @@ class ResTypes:
     RES_TABLE_TYPE_SPEC_TYPE = 0x0202
 
 
-def parsestruct(buf, structformat):
-    size = struct.calcsize(structformat)
-    return struct.unpack(structformat, buf[:size])
+def parsestruct(buf, structformat, offset=0):
+    return struct.unpack_from(structformat, buf, offset)
+
+
+def mapfile(source, copy=False):
+    """
+    Maps the file at path or file descriptor source read-only, so only the pages that are actually parsed get read
+    and processes reading the same file share the page cache. Any other source is returned as it is.
+    With copy=True the file is read into memory instead, for documents that may be written back over the file
+    they came from: views into a mapping would then point at the file being truncated.
+    """
+    if isinstance(source, int):
+        mapped = mmap.mmap(source, 0, access=mmap.ACCESS_READ)
+    elif isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as fp:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        return source
+    if not copy:
+        return mapped
+    with mapped:
+        return mapped[:]
 
 
 class ResXMLElement:
-    def __init__(self, node, stringpool, namespace, name):
+    def __init__(self, node, stringpool, namespace, name, buffer=None, start=0):
         self._node = node
         self._stringpool = stringpool
         self._namespace = namespace
         self._name = name
+        self._buf = buffer
+        self._start = start
 
-    def tobytes(self):
+    def iterchunks(self):
+        if self._buf is not None and not self._stringpool.refsmoved:
+            yield self._buf[self._start:self._start + self.size]
+            return
         ns = 0xffffffff if not self._namespace else self._stringpool.getstringref(self._namespace)
         n = self._stringpool.getstringref(self._name)
-        return struct.pack('II', ns, n)
+        yield struct.pack('II', ns, n)
+
+    def tobytes(self):
+        return b''.join(self.iterchunks())
+
+    def iterreferences(self):
+        return iter([i for i in (self._namespace, self._name) if i])
 
     @property
     def node(self):
@@ -82,50 +136,99 @@ class ResXMLElement:
         return 8
 
 
+class Tracked(object):
+    """
+    Records of a parsed element are switched to a Tracked subclass of their own class once parsed, so setting any of
+    their fields marks the element that owns them dirty. Elements nobody changed are then written back as a copy of
+    their original bytes, and parsing itself doesn't pay for the tracking.
+    """
+    __slots__ = ()
+    CLASSES = {}
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[0] != '_':
+            self._owner.touch()
+
+    @staticmethod
+    def track(owner, *records):
+        for record in records:
+            cls = type(record)
+            tracked = Tracked.CLASSES.get(cls)
+            if tracked is None:
+                tracked = Tracked.CLASSES[cls] = type(cls.__name__, (Tracked, cls), {'__slots__': ()})
+            record._owner = owner
+            record.__class__ = tracked
+
+
 @Struct('I', ['ref'])
 class ResourceRef(object):
+    __slots__ = ('_stringpool', '_value', '_ref', '_owner')
+
     def __init__(self, stringpool, value=None):
         self._stringpool = stringpool
         self._value = value
         self._ref = AML.NONE_NAMESPACE_REF
 
+    def iterreferences(self):
+        if self.value is not None:
+            yield self.value
+
     @property
     def value(self):
+        if self._value is None and self._ref != AML.NONE_NAMESPACE_REF:
+            self._value = self._stringpool.originalstrings[self._ref]
         return self._value
 
     @property
     def ref(self):
-        return AML.NONE_NAMESPACE_REF if self._value is None else self._stringpool.getstringref(self._value)
+        value = self.value
+        return AML.NONE_NAMESPACE_REF if value is None else self._stringpool.getstringref(value)
 
     @ref.setter
     def ref(self, ref):
         if ref != AML.NONE_NAMESPACE_REF:
-            self._value = self._stringpool.originalstrings[ref]
+            self._value = None
         self._ref = ref
 
-    def tobytes(self):
-        return struct.pack('I', self.ref)
-
 
 class ResChunk:
     @staticmethod
-    def parse(buf):
-        header, nul = ResChunk.Header.parse(buf, buffer=buf)
-        return header, buf[:header.chunkSize]
+    def parse(buf, offset=0):
+        header, nul = ResChunk.Header.parsefrom(buf, offset, buffer=buf, start=offset)
+        return header, buf[offset:offset + header.chunkSize]
 
     @Struct('HHI', ['type', 'headerSize', 'chunkSize'])
     class Header:
-        def __init__(self, buffer=None):
+        __slots__ = ('_buf', '_start')
+
+        def __init__(self, buffer=None, start=0):
             self._buf = buffer
+            self._start = start
+
+        @property
+        def offset(self):
+            return self._start
+
+        @property
+        def bodyoffset(self):
+            return self._start + self.headerSize
+
+        @property
+        def nextoffset(self):
+            return self._start + self.chunkSize
 
         def tobytesbybuf(self):
-            return self._buf[:self.headerSize]
+            return self._buf[self._start:self.bodyoffset]
 
         def getbody(self):
-            return self._buf[self.headerSize:self.chunkSize]
+            return self._buf[self.bodyoffset:self.nextoffset]
+
+        def getchunkbuf(self):
+            return self._buf[self._start:self.nextoffset]
 
         def getnextchunkbuf(self):
-            return self._buf[self.chunkSize:]
+            return self._buf[self.nextoffset:]
 
         def dump(self):
             print('type = 0x%04x headerSize = %d size = %d' % (self.type, self.headerSize, self.chunkSize))
@@ -134,7 +237,24 @@ class ResChunk:
 @Struct([ResourceRef, ResourceRef, 'HHHHHH'], ['ns', 'name', 'attributeStart', 'attributeSize',
                                                'attributeCount', 'idIndex', 'classIndex', 'styleIndex'])
 class ResXMLTree_attrExt:
-    pass
+    __slots__ = ('_owner',)
+
+
+def _formatfloat(data):
+    """The shortest text that reads back as the same single-precision float."""
+    packed = struct.pack('<I', data)
+    value = struct.unpack('<f', packed)[0]
+    for precision in (6, 7, 8):
+        text = '%.*g' % (precision, value)
+        if struct.pack('<f', float(text)) == packed:
+            return text
+    return '%.9g' % value
+
+
+def _formatcomplex(data, units, scale=1):
+    value = ctypes.c_int32(data & 0xffffff00).value * Res_value.COMPLEX_RADIX_MULTS[(data >> 4) & 0x3] * scale
+    unit = data & 0xf
+    return '%s%s' % (value, units[unit] if unit < len(units) else '')
 
 
 @Struct('HBBI', ['size', 'res0', 'dataType', 'data'])
@@ -157,6 +277,12 @@ class Res_value(object):
     # The 'data' holds a complex number encoding a fraction of a
     # container.
     TYPE_FRACTION = 0x06
+    # The 'data' holds a dynamic ResTable_ref, which needs to be
+    # resolved before it can be used like a TYPE_REFERENCE.
+    TYPE_DYNAMIC_REFERENCE = 0x07
+    # The 'data' holds an attribute resource identifier, which needs to be resolved
+    # before it can be used like a TYPE_ATTRIBUTE.
+    TYPE_DYNAMIC_ATTRIBUTE = 0x08
 
     # Beginning of integer flavors...
     TYPE_FIRST_INT = 0x10
@@ -186,14 +312,46 @@ class Res_value(object):
     # ...end of integer flavors.
     TYPE_LAST_INT = 0x1f
 
+    # Multipliers of the 24 bit mantissa of dimensions and fractions, by radix.
+    COMPLEX_RADIX_MULTS = (1.0 / (1 << 8), 1.0 / (1 << 15), 1.0 / (1 << 23), 1.0 / (1 << 31))
+    COMPLEX_DIMENSION_UNITS = ('px', 'dip', 'sp', 'pt', 'in', 'mm')
+    COMPLEX_FRACTION_UNITS = ('%', '%p')
+
+    # Formats the data of every type but TYPE_STRING, by dataType.
+    FORMATS = {
+        TYPE_NULL: lambda data: '@empty' if data == 1 else '@null',
+        TYPE_REFERENCE: lambda data: '@%08x' % data if data else '@null',
+        TYPE_ATTRIBUTE: lambda data: '?%08x' % data,
+        TYPE_FLOAT: _formatfloat,
+        TYPE_DIMENSION: lambda data: _formatcomplex(data, Res_value.COMPLEX_DIMENSION_UNITS),
+        TYPE_FRACTION: lambda data: _formatcomplex(data, Res_value.COMPLEX_FRACTION_UNITS, 100),
+        TYPE_DYNAMIC_REFERENCE: lambda data: '@%08x' % data,
+        TYPE_DYNAMIC_ATTRIBUTE: lambda data: '?%08x' % data,
+        TYPE_INT_DEC: lambda data: str(ctypes.c_int32(data).value),
+        TYPE_INT_HEX: lambda data: '0x%08x' % data,
+        TYPE_INT_BOOLEAN: lambda data: 'true' if data else 'false',
+        TYPE_INT_COLOR_ARGB8: lambda data: '#%08x' % data,
+        TYPE_INT_COLOR_RGB8: lambda data: '#%06x' % (data & 0xffffff),
+        TYPE_INT_COLOR_ARGB4: lambda data: '#%x%x%x%x' % ((data >> 28) & 0xf, (data >> 20) & 0xf,
+                                                          (data >> 12) & 0xf, (data >> 4) & 0xf),
+        TYPE_INT_COLOR_RGB4: lambda data: '#%x%x%x' % ((data >> 20) & 0xf, (data >> 12) & 0xf, (data >> 4) & 0xf),
+    }
+
+    __slots__ = ('_data', '_stringpool', '_value', '_owner')
+
     def __init__(self, stringpool, value=None):
         self._data = 0
         self._stringpool = stringpool
         self._value = value
 
+    def _getstring(self):
+        if self._value is None and self._data != AML.NONE_NAMESPACE_REF:
+            self._value = self._stringpool.originalstrings[self._data]
+        return self._value
+
     @property
     def data(self):
-        if self.dataType == Res_value.TYPE_STRING and self._value:
+        if self.dataType == Res_value.TYPE_STRING and self._getstring():
             return self._stringpool.getstringref(self._value)
         return self._data
 
@@ -201,28 +359,41 @@ class Res_value(object):
     def data(self, val):
         self._data = val
         if self.dataType == Res_value.TYPE_STRING and val != AML.NONE_NAMESPACE_REF:
-            self._value = self._stringpool.originalstrings[val]
+            self._value = None
+
+    def iterreferences(self):
+        if self.dataType == Res_value.TYPE_STRING and self._getstring() is not None:
+            yield self._value
 
     @property
     def value(self):
-        if self.dataType == Res_value.TYPE_INT_DEC:
-            return str(ctypes.c_int32(self._data).value)
-        elif self.dataType == Res_value.TYPE_STRING:
-            return self._stringpool.getstringbyref(self._data)
-        elif self.dataType == Res_value.TYPE_INT_BOOLEAN:
-            return 'true' if self._data else 'false'
-        return '@%08x' % self._data
+        if self.dataType == Res_value.TYPE_STRING:
+            return self._getstring()
+        return Res_value.formatdata(self.dataType, self._data)
+
+    @staticmethod
+    def formatdata(datatype, data):
+        format = Res_value.FORMATS.get(datatype)
+        return '@%08x' % data if format is None else format(data)
 
 
 @Struct('II', ['lineNumber', 'comment'])
 class ResXMLTree_node:
-    pass
+    __slots__ = ('_owner',)
 
 
 @Struct([ResourceRef, ResourceRef, 'I', Res_value], ['ns', 'name', 'rawValue', 'typedValue'])
 class ResXMLTree_attribute:
-    def __init__(self, aml=None):
+    __slots__ = ('_aml', '_buf', '_start', '_owner')
+
+    def __init__(self, aml=None, buffer=None, start=0):
         self._aml = aml
+        self._buf = buffer
+        self._start = start
+
+    @property
+    def offset(self):
+        return self._start
 
     @property
     def namespace(self):
@@ -256,21 +427,177 @@ class ResXMLTree_attribute:
             self.rawValue = self.typedValue.data
         return self._tobytes()
 
+    def iterreferences(self):
+        return itertools.chain(self.ns.iterreferences(), self.name.iterreferences(), self.typedValue.iterreferences())
+
+    def patch(self, value):
+        """
+        Overwrites the value of a parsed attribute directly in the document buffer, which has to be writable
+        (a bytearray or a writable mmap). Only same-size edits are possible: integers, booleans, and strings
+        that already exist in the string pool.
+        """
+        if self._buf is None:
+            raise AssertionError('Cannot patch an attribute that was not parsed!')
+        if self._buf.readonly:
+            raise AssertionError('Cannot patch a read-only buffer!')
+        if type(value) is str:
+            if value not in self._aml.strings:
+                raise AssertionError('Cannot patch in a string that is not in the string pool!')
+            rawvalue = data = self._aml.strings.getstringref(value)
+            datatype = Res_value.TYPE_STRING
+        elif type(value) is bool:
+            rawvalue, datatype, data = AML.NONE_NAMESPACE_REF, Res_value.TYPE_INT_BOOLEAN, 0xffffffff if value else 0
+        elif type(value) is int:
+            datatype = self.typedValue.dataType
+            if not Res_value.TYPE_FIRST_INT <= datatype <= Res_value.TYPE_LAST_INT or datatype == Res_value.TYPE_INT_BOOLEAN:
+                datatype = Res_value.TYPE_INT_DEC
+            rawvalue, data = AML.NONE_NAMESPACE_REF, value & 0xffffffff
+        else:
+            print('Other data types aren\'t supported, sorry')
+            raise NotImplementedError()
+        struct.pack_into('IHBBI', self._buf, self._start + 8, rawvalue, 8, 0, datatype, data)
+        self.rawValue = rawvalue
+        self.typedValue.size = 8
+        self.typedValue.res0 = 0
+        self.typedValue.dataType = datatype
+        self.typedValue.data = data
+
+
+class ResXMLAttributeList(collections.abc.MutableSequence):
+    """
+    The attributes of a parsed start element. Each record is only parsed into a ResXMLTree_attribute the first
+    time it is accessed, until then the list just keeps its offset in the document buffer.
+    """
+
+    def __init__(self, aml, buf, offset, count, attributesize):
+        self._aml = aml
+        self._buf = buf
+        self._items = [offset + i * attributesize for i in range(count)]
+        self._dirty = False
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        attribute = self._items[item]
+        if type(attribute) is int:
+            attribute, nul = ResXMLTree_attribute.parsefrom(self._buf, attribute, stringpool=self._aml.stringpool,
+                                                            aml=self._aml, buffer=self._buf, start=attribute)
+            Tracked.track(self, attribute, attribute.ns, attribute.name, attribute.typedValue)
+            self._items[item] = attribute
+        return attribute
+
+    def __setitem__(self, item, attribute):
+        self._items[item] = attribute
+        self._dirty = True
+
+    def __delitem__(self, item):
+        del self._items[item]
+        self._dirty = True
+
+    def __len__(self):
+        return len(self._items)
+
+    def insert(self, index, attribute):
+        self._items.insert(index, attribute)
+        self._dirty = True
+
+    def touch(self):
+        self._dirty = True
+
+    @property
+    def dirty(self):
+        """Whether attributes were added, removed, replaced or had a field set since the element was parsed."""
+        return self._dirty
+
+    def find(self, name):
+        stringpool = self._aml.stringpool
+        strings = stringpool.originalstrings
+        # Names may be stripped from the pool, the resource map still has their ids.
+        idrefs = ()
+        attrid = AML.ResourceMapChunk.REGISTRY.getattrid(name)
+        if attrid is not None and stringpool.resourcemap is not None:
+            idrefs = set([i for i, (attrname, j) in enumerate(stringpool.resourcemap.attrs) if j == attrid])
+        # Only the names of these records get decoded, not the whole pool.
+        for i, item in enumerate(self._items):
+            if type(item) is int:
+                ref, = parsestruct(self._buf, 'I', item + 4)
+            elif item.attributename or item._buf is None:
+                if item.attributename == name:
+                    return item
+                continue
+            else:
+                ref, = parsestruct(item._buf, 'I', item.offset + 4)
+            if ref in idrefs or (ref < len(strings) and strings[ref] == name):
+                return self[i]
+        return None
+
 
 @Struct([ResChunk.Header, ResXMLTree_node, ResXMLTree_attrExt], ['header', 'node', 'attrExt'])
 class ResXMLTree:
-    def __init__(self, aml):
-        self._attributes = []
+    __slots__ = ('_attributes', '_aml', '_buf', '_start', '_dirty')
+
+    def __init__(self, aml, buffer=None, start=0):
+        self._attributes = [] if buffer is None else None
         self._aml = aml
+        self._buf = buffer
+        self._start = start
+        self._dirty = buffer is None
+
+    @staticmethod
+    def parsefrom(buf, offset, *args, **kwargs):
+        tree, offset = ResXMLTree._parsefrom(buf, offset, *args, **kwargs)
+        Tracked.track(tree, tree.node, tree.attrExt, tree.attrExt.ns, tree.attrExt.name)
+        return tree, offset
+
+    def touch(self):
+        self._dirty = True
+
+    @property
+    def dirty(self):
+        """Whether a field of the element or its attributes was set, or attributes changed, since it was parsed."""
+        return self._dirty or (self._attributes is not None and self._attributes.dirty)
 
     @property
     def attributes(self):
+        if self._attributes is None:
+            self._attributes = ResXMLAttributeList(self._aml, self._buf,
+                                                   self._start + self.header.headerSize + self.attrExt.attributeStart,
+                                                   self.attrExt.attributeCount, self.attrExt.attributeSize)
         return self._attributes
 
-    def tobytes(self):
+    def getattribute(self, name):
+        attributes = self.attributes
+        if isinstance(attributes, ResXMLAttributeList):
+            return attributes.find(name)
+        for i in attributes:
+            if i.attributename == name:
+                return i
+        return None
+
+    def attributecolumns(self):
+        if self._buf is None:
+            raise AssertionError('Attribute columns are only available for parsed elements!')
+        bodyoffset = self._start + self.header.headerSize
+        records = AttributeColumns.packrecords(self._buf, bodyoffset + self.attrExt.attributeStart,
+                                               self.attrExt.attributeCount, self.attrExt.attributeSize)
+        return AttributeColumns(records, array.array('I', [0]) * self.attrExt.attributeCount,
+                                array.array('I', parsestruct(self._buf, 'I', bodyoffset + 4)), self._aml.stringpool)
+
+    def iterchunks(self):
+        """Yields the element record, as a view into the document buffer if nothing about it changed."""
+        if self._buf is not None and not self.dirty and not self._aml.stringpool.refsmoved:
+            yield self._buf[self._start:self._start + self.header.chunkSize]
+            return
         self.header.chunkSize = self.size
-        self.attrExt.attributeCount = len(self._attributes)
-        return self._tobytes() + b''.join([i.tobytes() for i in self._attributes])
+        self.attrExt.attributeCount = self.attrExt.attributeCount if self._attributes is None else len(self._attributes)
+        yield self._tobytes() + b''.join([i.tobytes() for i in self.attributes])
+
+    def tobytes(self):
+        return b''.join(self.iterchunks())
+
+    def iterreferences(self):
+        return itertools.chain(self.attrExt.ns.iterreferences(), self.attrExt.name.iterreferences(),
+                               *[i.iterreferences() for i in self.attributes])
 
     @property
     def nodename(self):
@@ -278,23 +605,224 @@ class ResXMLTree:
 
     @property
     def size(self):
-        return ResXMLTree._size + sum([i.size for i in self._attributes])
+        count = self.attrExt.attributeCount if self._attributes is None else len(self._attributes)
+        return ResXMLTree._size + count * ResXMLTree_attribute.size
+
+
+class AttributeColumns(object):
+    """
+    Column-oriented view over raw ResXMLTree_attribute records, decoded with one struct.iter_unpack call.
+    Every column is an array indexed by attribute row; 'element' holds the ordinal of the start element the
+    row belongs to, and elementnames holds the name string ref of each element by ordinal.
+    """
+    FIELDS = ('ns', 'name', 'rawValue', 'size', 'res0', 'dataType', 'data')
+    TYPECODES = ('I', 'I', 'I', 'H', 'B', 'B', 'I')
+    DTYPE = [('ns', '<u4'), ('name', '<u4'), ('rawValue', '<u4'), ('size', '<u2'), ('res0', 'u1'),
+             ('dataType', 'u1'), ('data', '<u4')]
+
+    def __init__(self, records, elements, elementnames, stringpool=None):
+        self._records = records
+        self._elements = elements
+        self._elementnames = elementnames
+        self._stringpool = stringpool
+        self._strings = None if stringpool is None else AML.StringList(stringpool.originalstrings)
+        self._columns = None
+
+    @staticmethod
+    def packrecords(buf, offset, count, attributesize):
+        size = ResXMLTree_attribute.size
+        if attributesize == size:
+            return buf[offset:offset + count * size]
+        return b''.join([buf[offset + i * attributesize:offset + i * attributesize + size] for i in range(count)])
+
+    @staticmethod
+    def scan(buffer):
+        buf = memoryview(mapfile(buffer))
+        root, nul = ResChunk.Header.parsefrom(buf, 0)
+        offset, end = root.headerSize, min(root.chunkSize, len(buf))
+        stringpool = None
+        records = []
+        elements = array.array('I')
+        elementnames = array.array('I')
+        while offset < end:
+            header, nul = ResChunk.Header.parsefrom(buf, offset, buffer=buf, start=offset)
+            if header.type == ResTypes.RES_STRING_POOL_TYPE:
+                stringpool = AML.StringPoolChunk(buf, offset)
+            elif header.type == ResTypes.RES_XML_START_ELEMENT_TYPE:
+                ns, name, attributeStart, attributeSize, attributeCount = parsestruct(buf, 'IIHHH', header.bodyoffset)
+                records.append(AttributeColumns.packrecords(buf, header.bodyoffset + attributeStart,
+                                                            attributeCount, attributeSize))
+                elements.extend(array.array('I', [len(elementnames)]) * attributeCount)
+                elementnames.append(name)
+            offset = header.nextoffset
+        return AttributeColumns(b''.join(records), elements, elementnames, stringpool)
+
+    def _getcolumns(self):
+        if self._columns is None:
+            rows = struct.iter_unpack(ResXMLTree_attribute._STRUCT_FORMAT, self._records)
+            columns = list(zip(*rows)) or [()] * len(AttributeColumns.FIELDS)
+            self._columns = dict((name, array.array(typecode, column)) for name, typecode, column
+                                 in zip(AttributeColumns.FIELDS, AttributeColumns.TYPECODES, columns))
+            self._columns['element'] = self._elements
+        return self._columns
+
+    def __getitem__(self, column):
+        return self._getcolumns()[column]
+
+    def __len__(self):
+        return len(self._records) // ResXMLTree_attribute.size
+
+    @property
+    def elementnames(self):
+        return self._elementnames
+
+    def getstring(self, ref):
+        return self._stringpool.originalstrings[ref]
+
+    def getref(self, s):
+        return AML.NONE_NAMESPACE_REF if s is None else self._strings.getstringref(s)
+
+    def select(self, **criteria):
+        """
+        Returns the rows whose columns equal every criterion. 'ns' and 'name' may be given as strings, and
+        'elementname' filters on the name of the owning element.
+        """
+        conditions = []
+        for column, value in criteria.items():
+            if column in ('ns', 'name', 'elementname') and (value is None or type(value) is str):
+                if value is not None and value not in self._strings:
+                    return []
+                value = self.getref(value)
+            if column == 'elementname':
+                elements = set([i for i, j in enumerate(self._elementnames) if j == value])
+                conditions.append(lambda row, elements=elements: self._elements[row] in elements)
+            else:
+                conditions.append(lambda row, column=self[column], value=value: column[row] == value)
+        return [i for i in range(len(self)) if all([condition(i) for condition in conditions])]
+
+    def tonumpy(self):
+        import numpy
+        return numpy.frombuffer(self._records, dtype=AttributeColumns.DTYPE)
+
+
+class AttributeTable(collections.abc.Mapping):
+    """
+    The R.attr name to resource id table. The json resource is only loaded the first time the table is used, and
+    getname() maps a resource id back to its attribute name.
+    """
+
+    def __init__(self, resource):
+        self._resource = resource
+        self._ids = None
+        self._names = None
+
+    def _getids(self):
+        if self._ids is None:
+            import json
+            self._ids = json.loads(pkgutil.get_data('libaml', self._resource))
+        return self._ids
+
+    def __getitem__(self, attrname):
+        return self._getids()[attrname]
+
+    def __contains__(self, attrname):
+        return attrname in self._getids()
+
+    def __iter__(self):
+        return iter(self._getids())
+
+    def __len__(self):
+        return len(self._getids())
+
+    def getname(self, attrid):
+        if self._names is None:
+            self._names = dict((j, i) for i, j in self._getids().items())
+        return self._names.get(attrid)
+
+
+class AttributeRegistry(object):
+    """
+    R.attr ids across API levels. A published attribute id never changes, so every name/id pair is stored once in
+    parallel arrays along with the lowest level it was registered for, and a level only limits which entries are
+    visible. Registered tables are merged on the first lookup, and lookups are memoized per level.
+    """
+
+    def __init__(self):
+        self._tables = []
+        self._names = []
+        self._ids = array.array('I')
+        self._levels = array.array('H')
+        self._byname = {}
+        self._byid = {}
+        self._idmemo = {}
+        self._namememo = {}
+
+    def register(self, level, table):
+        """Registers a name -> id mapping as available from API level on, level 0 meaning every level."""
+        self._tables.append((level, table))
+        self._idmemo.clear()
+        self._namememo.clear()
+
+    def _merge(self):
+        while self._tables:
+            level, table = self._tables.pop(0)
+            for name, attrid in table.items():
+                index = self._byname.get(name)
+                if index is None:
+                    self._byname[name] = len(self._names)
+                    self._byid.setdefault(attrid, len(self._names))
+                    self._names.append(name)
+                    self._ids.append(attrid)
+                    self._levels.append(level)
+                elif self._ids[index] != attrid:
+                    raise AssertionError('R.attr.%s is registered with two different ids!' % name)
+                elif level < self._levels[index]:
+                    self._levels[index] = level
+
+    def _visible(self, index, level):
+        return index is not None and (level is None or self._levels[index] <= level)
+
+    def getattrid(self, attrname, level=None):
+        """Returns the id of R.attr.attrname at API level, or None. A level of None means the latest one."""
+        key = (attrname, level)
+        if key not in self._idmemo:
+            self._merge()
+            index = self._byname.get(attrname)
+            self._idmemo[key] = self._ids[index] if self._visible(index, level) else None
+        return self._idmemo[key]
+
+    def getname(self, attrid, level=None):
+        key = (attrid, level)
+        if key not in self._namememo:
+            self._merge()
+            index = self._byid.get(attrid)
+            self._namememo[key] = self._names[index] if self._visible(index, level) else None
+        return self._namememo[key]
+
+    def __contains__(self, attrname):
+        return self.getattrid(attrname) is not None
 
 
 class AML:
     ANDROID_NAMESPACE = 'http://schemas.android.com/apk/res/android'
     NONE_NAMESPACE_REF = 0xffffffff
+    XML_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', '\n': '&#10;'})
 
     class StringList:
         def __init__(self, strings):
             self._strings = strings
-            self._stringmapping = dict((j, i) for i, j in enumerate(strings))
+            self._stringmapping = None
+
+        def _getmapping(self):
+            if self._stringmapping is None:
+                self._stringmapping = dict((j, i) for i, j in enumerate(self._strings))
+            return self._stringmapping
 
         def getstringref(self, s):
-            return self._stringmapping[s]
+            return self._getmapping()[s]
 
         def __contains__(self, item):
-            return item in self._stringmapping
+            return item in self._getmapping()
 
         def __getitem__(self, item):
             return self._strings[item]
@@ -318,20 +846,33 @@ class AML:
         def append(self, data):
             self._bytebuffer.append(data)
 
-        def tobytes(self):
+        def iterchunks(self):
             self._header.chunkSize = self.size + self._header.headerSize
-            return b''.join([self._header.tobytes(),
-                             self._header.tobytesbybuf()[ResChunk.Header.size:],
-                             self._bytebuffer.tobytes()])
+            yield self._header.tobytes()
+            yield self._header.tobytesbybuf()[ResChunk.Header.size:]
+            for i in self._bytebuffer.iterchunks():
+                yield i
+
+        def iterreferences(self):
+            return self._bytebuffer.iterreferences()
+
+        def tobytes(self):
+            return b''.join(self.iterchunks())
 
     class ResourceMapChunk:
-        ATTRS = eval(pkgutil.get_data('libaml', 'android-attrs.json'))
+        ATTRS = AttributeTable('android-attrs.json')
+        REGISTRY = AttributeRegistry()
+        REGISTRY.register(0, ATTRS)
+
         def __init__(self, header, strings):
             self._header = header
             idlen = int((header.chunkSize - header.headerSize) / 4)
             ids = parsestruct(header.getbody(), str(idlen) + 'I')
             self._attrs = [(strings[i], j) for i, j in enumerate(ids)]
-            self._attrset = set([i for i, j in self._attrs])
+            self._originalcount = len(self._attrs)
+            self._compacted = False
+            self._attrnames = [i for i, j in self._attrs]
+            self._attrindices = dict((j, i) for i, j in enumerate(self._attrnames))
 
         @property
         def attrs(self):
@@ -339,25 +880,63 @@ class AML:
 
         @property
         def attrnames(self):
-            return [i for i, j in self._attrs]
+            return self._attrnames
 
         def __contains__(self, attrname):
-            return attrname in self._attrset
+            return attrname in self._attrindices
+
+        def __len__(self):
+            return len(self._attrs)
 
-        def append(self, attrname):
-            if attrname not in AML.ResourceMapChunk.ATTRS:
+        @property
+        def modified(self):
+            return self._compacted or len(self._attrs) != self._originalcount
+
+        def getattrref(self, attrname):
+            return self._attrindices[attrname]
+
+        def getattrid(self, attrname, apilevel=None):
+            attrid = AML.ResourceMapChunk.REGISTRY.getattrid(attrname, apilevel)
+            if attrid is None:
                 print("Couldn't find R.attr.%s value" % attrname)
                 raise NotImplementedError()
-            self._attrs.append((attrname, AML.ResourceMapChunk.ATTRS[attrname]))
+            return attrid
+
+        def append(self, attrname, apilevel=None):
+            self._attrs.append((attrname, self.getattrid(attrname, apilevel)))
+            self._attrnames.append(attrname)
+            self._attrindices.setdefault(attrname, len(self._attrnames) - 1)
+
+        def retain(self, attrnames):
+            """Keeps the first entry of every attribute in attrnames, in order. Returns the number of entries removed."""
+            attrs = []
+            seen = set()
+            for attrname, attrid in self._attrs:
+                if attrname in attrnames and attrname not in seen:
+                    seen.add(attrname)
+                    attrs.append((attrname, attrid))
+            removed = len(self._attrs) - len(attrs)
+            if removed:
+                self._attrs = attrs
+                self._attrnames = [i for i, j in attrs]
+                self._attrindices = dict((j, i) for i, j in enumerate(self._attrnames))
+                self._compacted = True
+            return removed
 
         @property
         def size(self):
             return self._header.headerSize + len(self._attrs) * 4
 
-        def tobytes(self):
+        def iterchunks(self):
+            if not self.modified:
+                yield self._header.getchunkbuf()
+                return
             self._header.chunkSize = self.size
             resources = [i[1] for i in self._attrs]
-            return self._header.tobytes() + struct.pack(str(len(resources)) + 'I', *resources)
+            yield self._header.tobytes() + struct.pack(str(len(resources)) + 'I', *resources)
+
+        def tobytes(self):
+            return b''.join(self.iterchunks())
 
     class StringPoolChunk(object):
         # If set, the string index is sorted by the string values (based
@@ -366,58 +945,130 @@ class AML:
         # String pool is encoded in UTF-8
         UTF8_FLAG = 1 << 8
 
-        class _UTF16StringList:
-            def __init__(self, aml):
-                self._aml = aml
-
-            def loadstrings(self, buf):
-                strings = []
-                indices = {}
-                for i in range(self._aml.stringCount):
-                    stringlen = parsestruct(buf, 'H')[0]
-                    s = buf[2:2 + stringlen * 2].decode('utf-16')
-                    buf = buf[(stringlen + 1) * 2 + 2:]
-                    strings.append(s)
-                    indices[s] = i
-                return strings, indices
-
-            @property
-            def size(self):
-                return sum([len(i) * 2 + 4 for i in self._aml.strings])
-
-        class _UTF8StringList:
+        class _StringList(object):
             def __init__(self, aml):
                 self._aml = aml
+                self._size = None
 
-            def loadstrings(self, buf):
-                strings = []
-                indices = {}
-                for i in range(self._aml.stringCount):
-                    stringlen = parsestruct(buf, 'H')[0] & 0xff
-                    s = buf[2:2 + stringlen].decode('utf-8')
-                    buf = buf[(stringlen + 1) + 2:]
-                    strings.append(s)
-                    indices[s] = i
-                return strings, indices
+            def add(self, strings):
+                if self._size is not None:
+                    self._size += sum([len(self.encode(i)) for i in strings])
 
             @property
             def size(self):
-                return sum([len(i) + 3 for i in self._aml.strings])
-
-        def __init__(self, buf):
+                if self._size is None:
+                    self._size = sum([len(self.encode(i)) for i in self._aml.iterstrings()])
+                return self._size
+
+        class _UTF16StringList(_StringList):
+            def decode(self, buf, offset):
+                stringlen = parsestruct(buf, 'H', offset)[0]
+                if stringlen & 0x8000:
+                    stringlen = ((stringlen & 0x7fff) << 16) | parsestruct(buf, 'H', offset + 2)[0]
+                    offset += 2
+                return str(buf[offset + 2:offset + 2 + stringlen * 2], 'utf-16')
+
+            @staticmethod
+            def encode(s):
+                data = s.encode('utf-16-le')
+                stringlen = len(data) // 2
+                if stringlen > 0x7fff:
+                    return struct.pack('<HH', (stringlen >> 16) | 0x8000, stringlen & 0xffff) + data + b'\x00\x00'
+                return struct.pack('<H', stringlen) + data + b'\x00\x00'
+
+        class _UTF8StringList(_StringList):
+            @staticmethod
+            def _encodelength(length):
+                if length > 0x7fff:
+                    print('Strings longer than 0x7fff can\'t be stored in a UTF-8 string pool, sorry')
+                    raise NotImplementedError()
+                return bytes(((length >> 8) | 0x80, length & 0xff)) if length > 0x7f else bytes((length,))
+
+            @staticmethod
+            def encode(s):
+                data = s.encode('utf-8')
+                stringlen = len(s.encode('utf-16-le')) // 2
+                encodelength = AML.StringPoolChunk._UTF8StringList._encodelength
+                return encodelength(stringlen) + encodelength(len(data)) + data + b'\x00'
+
+            @staticmethod
+            def _decodelength(buf, offset):
+                length = buf[offset]
+                if length & 0x80:
+                    return ((length & 0x7f) << 8) | buf[offset + 1], offset + 2
+                return length, offset + 1
+
+            def decode(self, buf, offset):
+                nul, offset = self._decodelength(buf, offset)
+                stringlen, offset = self._decodelength(buf, offset)
+                return str(buf[offset:offset + stringlen], 'utf-8')
+
+        class _LazyStringList(object):
+            def __init__(self, stringlist, buf, offset, offsets, start=0, cache=None):
+                self._stringlist = stringlist
+                self._buf = buf
+                self._offset = offset
+                self._offsets = offsets
+                self._start = start
+                self._cache = [None] * len(offsets) if cache is None else cache
+
+            def __getitem__(self, item):
+                if isinstance(item, slice):
+                    if item.stop is None and item.step is None and (item.start or 0) >= 0:
+                        return AML.StringPoolChunk._LazyStringList(self._stringlist, self._buf, self._offset, self._offsets,
+                                                                   min(self._start + (item.start or 0), len(self._offsets)),
+                                                                   self._cache)
+                    return [self[i] for i in range(*item.indices(len(self)))]
+                if item < 0:
+                    item += len(self)
+                if not 0 <= item < len(self):
+                    raise IndexError('string index out of range')
+                item += self._start
+                s = self._cache[item]
+                if s is None:
+                    s = self._stringlist.decode(self._buf, self._offset + self._offsets[item])
+                    self._cache[item] = s
+                return s
+
+            def __iter__(self):
+                return (self[i] for i in range(len(self)))
+
+            def __len__(self):
+                return len(self._offsets) - self._start
+
+        def __init__(self, buf, offset=0):
             self._resourcemap = None
-            self._header, self._body = ResChunk.Header.parse(buf, buffer=buf)
-            self.stringCount, self.styleCount, self.flags, self.stringsStart, self.stylesStart = parsestruct(buf[8:], '5I')
-            self._stringlist = self._UTF8StringList(self) if self.flags & AML.StringPoolChunk.UTF8_FLAG else self._UTF16StringList(self)
-            self._strings, self._indices = self._stringlist.loadstrings(buf[self.stringsStart:])
-            self._originalstrings = list(self._strings)
+            self._header, nul = ResChunk.Header.parsefrom(buf, offset, buffer=buf, start=offset)
+            self.stringCount, self.styleCount, self.flags, self.stringsStart, self.stylesStart = parsestruct(buf, '5I', offset + 8)
+            self._utf8list = AML.StringPoolChunk._UTF8StringList(self)
+            self._utf16list = AML.StringPoolChunk._UTF16StringList(self)
+            self._stringlist = self._utf8list if self.utf8 else self._utf16list
+            self._original = buf[offset:offset + self._header.chunkSize]
+            self._originalflags = self.flags
+            offsets = parsestruct(buf, str(self.stringCount) + 'I', offset + self._header.headerSize)
+            self._originalstrings = AML.StringPoolChunk._LazyStringList(self._stringlist, buf, offset + self.stringsStart, offsets)
+            self._strings = self._originalstrings
+            self._indices = None
+            self._pendingattrs = None
+            self._pendingstrings = None
+            self._compacted = False
 
         @property
         def originalstrings(self):
             return self._originalstrings
 
+        @property
+        def modified(self):
+            return self._compacted or self.stringCount != len(self._originalstrings) or self.flags != self._originalflags
+
+        @property
+        def refsmoved(self):
+            return self._compacted or self._resourcemap is not None and self._resourcemap.modified
+
         @property
         def size(self):
+            if not self.modified:
+                return len(self._original)
             size = self.stringslen()
             return size + (4 - size % 4) % 4
 
@@ -427,7 +1078,21 @@ class AML:
 
         @property
         def strings(self):
-            return list(self._strings if self._resourcemap is None else self._resourcemap.attrnames + self._strings)
+            return list(self.iterstrings())
+
+        def iterstrings(self):
+            return itertools.chain(self.attrs, self._strings)
+
+        @property
+        def utf8(self):
+            return bool(self.flags & AML.StringPoolChunk.UTF8_FLAG)
+
+        @utf8.setter
+        def utf8(self, utf8):
+            if utf8:
+                self.flags |= AML.StringPoolChunk.UTF8_FLAG
+            else:
+                self.flags &= ~AML.StringPoolChunk.UTF8_FLAG
 
         @property
         def resourcemap(self):
@@ -436,67 +1101,140 @@ class AML:
         @resourcemap.setter
         def resourcemap(self, resourcemap):
             attrlen = len(resourcemap.attrs)
-            self._strings = self.strings[attrlen:]
+            self._strings = self._strings[attrlen:]
             self._resourcemap = resourcemap
+            self._indices = None
+
+        def __contains__(self, s):
+            if self._indices is None:
+                self._rebuildindices()
+            return s in self._indices or (self._resourcemap is not None and s in self._resourcemap)
 
         def getstringref(self, s):
-            return self._indices[s]
+            if self._indices is None:
+                self._rebuildindices()
+            if s in self._indices:
+                return len(self.attrs) + self._indices[s]
+            if self._resourcemap is None:
+                raise KeyError(s)
+            return self._resourcemap.getattrref(s)
 
         def getstringbyref(self, ref):
-            attrslen = len(self.attrs)
-            return self.attrs[ref] if ref < attrslen else self._strings[ref - attrslen]
+            attrs = self.attrs
+            return attrs[ref] if ref < len(attrs) else self._strings[ref - len(attrs)]
 
         def stringslen(self):
-            return sum([len(i) * 2 + 4 for i in self.strings]) + self.stringCount * 4 + self._header.headerSize
+            stringlist = self._utf8list if self.utf8 else self._utf16list
+            return stringlist.size + self.stringCount * 4 + self._header.headerSize
 
         def _append(self, s):
             self.stringCount += 1
             self.stringsStart = self.stringCount * 4 + self._header.headerSize
+            self._utf8list.add([s])
+            self._utf16list.add([s])
 
         def _rebuildindices(self):
-            self._indices = dict((j, i) for i, j in enumerate(self.strings))
+            self._indices = dict((j, i) for i, j in enumerate(self._strings))
 
-        def setattribute(self, name, value):
+        def setattribute(self, name, value, apilevel=None):
             if name not in self._resourcemap:
-                self._resourcemap.append(name)
-                self._append(name)
+                if self._pendingattrs is None:
+                    self._resourcemap.append(name, apilevel)
+                    self._append(name)
+                elif name not in self._pendingattrs:
+                    self._resourcemap.getattrid(name, apilevel)
+                    self._pendingattrs[name] = apilevel
             if type(value) is str:
                 self.ensure(value)
-            self._rebuildindices()
 
         def ensure(self, s):
-            if s not in self._indices:
+            if s not in self:
+                if self._pendingstrings is not None:
+                    if s not in self._pendingattrs:
+                        self._pendingstrings[s] = True
+                    return
+                if not isinstance(self._strings, list):
+                    self._strings = list(self._strings)
                 self._strings.append(s)
                 self._append(s)
-                self._indices[s] = len(self.attrs) + len(self._strings) - 1
+                self._indices[s] = len(self._strings) - 1
+
+        def begin(self):
+            self._pendingattrs = {}
+            self._pendingstrings = {}
+
+        def commit(self):
+            apilevels, strings = self._pendingattrs, list(self._pendingstrings)
+            attrs = list(apilevels)
+            self.rollback()
+            for name in attrs:
+                self._resourcemap.append(name, apilevels[name])
+            if strings:
+                if not isinstance(self._strings, list):
+                    self._strings = list(self._strings)
+                start = len(self._strings)
+                self._strings.extend(strings)
+                self._indices.update((j, start + i) for i, j in enumerate(strings))
+            self.stringCount += len(attrs) + len(strings)
+            self.stringsStart = self.stringCount * 4 + self._header.headerSize
+            self._utf8list.add(attrs + strings)
+            self._utf16list.add(attrs + strings)
+
+        def rollback(self):
+            self._pendingattrs = None
+            self._pendingstrings = None
+
+        def compact(self, used):
+            """
+            Drops every string that is not in used, along with duplicates, so the refs written afterwards are
+            remapped to the new positions. Unused attribute names leave the resource map together with their ids,
+            which keeps the pool and the map in the same order. Returns the number of strings removed.
+            """
+            removed = 0 if self._resourcemap is None else self._resourcemap.retain(used)
+            strings = []
+            seen = set()
+            for i in self._strings:
+                if i in used and i not in seen:
+                    seen.add(i)
+                    strings.append(i)
+            removed += len(self._strings) - len(strings)
+            if removed:
+                self._strings = strings
+                self._rebuildindices()
+                self.stringCount = len(self.attrs) + len(strings)
+                self.stringsStart = self.stringCount * 4 + self._header.headerSize
+                self._utf8list = AML.StringPoolChunk._UTF8StringList(self)
+                self._utf16list = AML.StringPoolChunk._UTF16StringList(self)
+                self._compacted = True
+            return removed
+
+        def iterchunks(self):
+            if not self.modified:
+                yield self._original
+                return
+            yield self._encode()
 
         def tobytes(self):
+            return b''.join(self.iterchunks())
+
+        def _encode(self):
             bos = ByteArrayBuffer()
             bos.append(self._header)
             self.stringCount = (0 if self._resourcemap is None else len(self._resourcemap.attrs)) + len(self._strings)
             self.stringsStart = self.stringCount * 4 + self._header.headerSize
             bos.append(struct.pack('5I', self.stringCount, self.styleCount, self.flags,
                                    self.stringsStart, self.stylesStart))
-
-            class OffsetCalculator:
-                def __init__(self):
-                    self._offset = 0
-
-                def offset(self, s):
-                    l = len(s) * 2 + 4
-                    o = self._offset
-                    self._offset += l
-                    return o
-
-            calculator = OffsetCalculator()
-            strings = self.strings
-            stringmaps = [calculator.offset(i) for i in strings]
-            bos.append(struct.pack(str(self.stringCount) + 'I', *stringmaps))
-            for i in strings:
-                bos.append(struct.pack(str(len(i) + 2) + 'H', *([len(i)] + [ord(j) for j in i] + [0])))
-            self._header.chunkSize = self.size
-            stringslen = self.stringslen()
-            bos.append(b'\x00' * (self._header.chunkSize - stringslen))
+            stringlist = self._utf8list if self.utf8 else self._utf16list
+            encoded = [stringlist.encode(i) for i in self.iterstrings()]
+            offsets = [0] * len(encoded)
+            offset = 0
+            for i, j in enumerate(encoded):
+                offsets[i] = offset
+                offset += len(j)
+            bos.append(struct.pack(str(self.stringCount) + 'I', *offsets))
+            bos.append(b''.join(encoded))
+            bos.append(b'\x00' * ((4 - offset % 4) % 4))
+            self._header.chunkSize = self.stringsStart + offset + (4 - offset % 4) % 4
             return bos.tobytes()
 
     class InsertedPlaceHolder:
@@ -506,12 +1244,21 @@ class AML:
             self._bytebuffer = ByteArrayBuffer()
 
         def append(self, data):
-            self._bytebuffer.append(data)
+            if self._aml._edits is None:
+                self._bytebuffer.append(data)
+            else:
+                self._aml._edits.append((self._bytebuffer, data))
 
         @property
         def size(self):
             return self._bytebuffer.size
 
+        def iterchunks(self):
+            return self._bytebuffer.iterchunks()
+
+        def iterreferences(self):
+            return self._bytebuffer.iterreferences()
+
         def tobytes(self):
             return self._bytebuffer.tobytes()
 
@@ -526,18 +1273,18 @@ class AML:
                                         attrExt, aml=self)
             androidns = ResourceRef(stringpool=stringpool, value=AML.ANDROID_NAMESPACE)
             for k, v in attrs.items():
-                stringpool.setattribute(k, v)
+                stringpool.setattribute(k, v, self._aml.apilevel)
                 attr = ResXMLTree_attribute.make(androidns, stringpool,
                                                  ResourceRef.create(stringpool=stringpool, value=k), v)
                 element.attributes.append(attr)
-            self._bytebuffer.append(element)
+            self.append(element)
             return element
 
         def writexmlendelement(self, name, linenumber=0):
-            self._bytebuffer.append(ResChunk.Header.create(ResTypes.RES_XML_END_ELEMENT_TYPE, 16, 24))
-            self._bytebuffer.append(ResXMLTree_node.create(linenumber or self._node.lineNumber, 0xffffffff))
-            self._bytebuffer.append(struct.pack('I', 0xffffffff))
-            self._bytebuffer.append(ResourceRef(self._aml.stringpool, name))
+            self.append(ResChunk.Header.create(ResTypes.RES_XML_END_ELEMENT_TYPE, 16, 24))
+            self.append(ResXMLTree_node.create(linenumber or self._node.lineNumber, 0xffffffff))
+            self.append(struct.pack('I', 0xffffffff))
+            self.append(ResourceRef(self._aml.stringpool, name))
 
     @Struct([ResourceRef, ResourceRef], ['_name', '_namespace'])
     class XMLNamespace:
@@ -549,72 +1296,116 @@ class AML:
         def namespace(self):
             return self._namespace.value
 
-    def __init__(self, buffer):
+        def iterreferences(self):
+            return itertools.chain(self._name.iterreferences(), self._namespace.iterreferences())
+
+    def __init__(self, buffer, readonly=False):
+        """
+        buffer is either the document itself or a path or file descriptor to read it from. Files are only mapped
+        with readonly=True, see mapfile(), otherwise they are read into memory so the document can be written back
+        over them.
+        With readonly=True nothing is kept for re-serialization: each event can be dropped as soon as the caller
+        moves past it, and insert()/tobytes() are unavailable.
+        """
         self._namespaces = {}
         self._stringpool = None
         self._strings = None
-        self._header, self._body = ResChunk.Header.parse(buffer, buffer=buffer)
-        self._rootchunk = AML.Chunk(self._header)
-        self._bufptr = self._rootchunk.body
+        self._buffer = memoryview(mapfile(buffer, copy=not readonly))
+        self._header, nul = ResChunk.Header.parsefrom(self._buffer, 0, buffer=self._buffer)
+        self._body = self._header.getbody()
+        self._rootchunk = None if readonly else AML.Chunk(self._header)
+        self._offset = self._header.bodyoffset
+        self._end = min(self._header.chunkSize, len(self._buffer))
         self._firstchunk = True
+        self._edits = None
+        self._apilevel = None
+        self._apilevelresolved = False
 
     @property
     def stringpool(self):
         return self._stringpool
 
+    @property
+    def readonly(self):
+        return self._rootchunk is None
+
+    @property
+    def buffer(self):
+        return self._buffer
+
     @property
     def strings(self):
         return self._strings
 
+    @property
+    def apilevel(self):
+        """
+        The API level attribute ids are resolved against when elements are inserted. Defaults to the manifest's
+        targetSdkVersion, or None (the latest level) if it has none.
+        """
+        if not self._apilevelresolved:
+            from .manifest import readmanifest
+            targetsdkversion = readmanifest(self._buffer).targetSdkVersion
+            self.apilevel = targetsdkversion if type(targetsdkversion) is int else None
+        return self._apilevel
+
+    @apilevel.setter
+    def apilevel(self, apilevel):
+        self._apilevel = apilevel
+        self._apilevelresolved = True
+
     @property
     def namespaces(self):
         return self._namespaces
 
+    def _append(self, data):
+        if self._rootchunk is not None:
+            self._rootchunk.append(data)
+
     def hasnext(self):
-        return self._firstchunk or len(self._bufptr) > 0
+        return self._firstchunk or self._offset < self._end
 
     def next(self):
         if self._firstchunk:
             self._firstchunk = False
             return self._header, self._body
-        self._header, chunk = ResChunk.parse(self._bufptr)
+        buf, offset = self._buffer, self._offset
+        self._header, chunk = ResChunk.parse(buf, offset)
         self._body = self._header.getbody()
         if self._header.type == ResTypes.RES_STRING_POOL_TYPE:
-            self._stringpool = AML.StringPoolChunk(self._bufptr)
-            self._strings = AML.StringList(self._stringpool.strings)
-            self._rootchunk.append(self._stringpool)
+            self._stringpool = AML.StringPoolChunk(buf, offset)
+            self._strings = AML.StringList(self._stringpool.originalstrings)
+            self._append(self._stringpool)
         elif self._header.type == ResTypes.RES_XML_START_NAMESPACE_TYPE:
-            self._body, nul = AML.XMLNamespace.parse(self._header.getbody(), stringpool=self._stringpool)
+            self._body, nul = AML.XMLNamespace.parsefrom(buf, self._header.bodyoffset, stringpool=self._stringpool)
             self._namespaces[self._body.namespace] = self._body.name
-            self._rootchunk.append(self._header.tobytesbybuf())
-            self._rootchunk.append(self._body)
+            self._append(self._header.tobytesbybuf())
+            self._append(self._body)
         elif self._header.type == ResTypes.RES_XML_START_ELEMENT_TYPE:
-            self._body, nul = ResXMLTree.parse(self._bufptr, aml=self, stringpool=self._stringpool)
-            self._rootchunk.append(self._body)
-            buf = self._header.getbody()[self._body.attrExt.attributeStart:]
-            for i in range(self._body.attrExt.attributeCount):
-                attribute, p = ResXMLTree_attribute.parse(buf, stringpool=self._stringpool, aml=self)
-                self._body.attributes.append(attribute)
-                buf = buf[self._body.attrExt.attributeSize:]
+            self._body, nul = ResXMLTree.parsefrom(buf, offset, aml=self, stringpool=self._stringpool, buffer=buf, start=offset)
+            self._append(self._body)
         elif self._header.type == ResTypes.RES_XML_END_ELEMENT_TYPE:
-            node, nul = ResXMLTree_node.parse(self._bufptr[8:])
-            ns, name = parsestruct(self._header.getbody(), 'II')
-            self._body = ResXMLElement(node, self._stringpool, None, self._strings[name])
-            self._rootchunk.append(self._header.tobytesbybuf())
-            self._rootchunk.append(self._body)
+            node, nul = ResXMLTree_node.parsefrom(buf, offset + 8)
+            ns, name = parsestruct(buf, 'II', self._header.bodyoffset)
+            self._body = ResXMLElement(node, self._stringpool, None, self._strings[name],
+                                       buffer=buf, start=self._header.bodyoffset)
+            self._append(self._header.tobytesbybuf())
+            self._append(self._body)
         elif self._header.type == ResTypes.RES_XML_END_NAMESPACE_TYPE:
-            self._body, nul = AML.XMLNamespace.parse(self._header.getbody(), stringpool=self._stringpool)
-            self._rootchunk.append(self._header.tobytesbybuf())
-            self._rootchunk.append(self._body)
+            self._body, nul = AML.XMLNamespace.parsefrom(buf, self._header.bodyoffset, stringpool=self._stringpool)
+            self._append(self._header.tobytesbybuf())
+            self._append(self._body)
         elif self._header.type == ResTypes.RES_XML_RESOURCE_MAP_TYPE:
             self._stringpool.resourcemap = AML.ResourceMapChunk(self._header, self._strings)
-            self._rootchunk.append(self._stringpool.resourcemap)
+            self._append(self._stringpool.resourcemap)
         else:
-            self._rootchunk.append(chunk)
-        self._bufptr = self._header.getnextchunkbuf()
+            self._append(chunk)
+        self._offset = self._header.nextoffset
         return self._header, self._body
 
     def insert(self):
+        if self.readonly:
+            raise AssertionError('Cannot insert into a read-only AML!')
         try:
             inserted = AML.InsertedPlaceHolder(self, self._body.node)
         except AttributeError:
@@ -622,5 +1413,218 @@ class AML:
         self._rootchunk.append(inserted)
         return inserted
 
-    def tobytes(self):
-        return self._rootchunk.tobytes()
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Batches string pool, resource map and element insertions made through insert() placeholders.
+        Everything queued inside the block is committed at once when it exits, or dropped if it raises.
+        """
+        if self._edits is not None:
+            yield self
+            return
+        if self._stringpool is None:
+            raise AssertionError('Cannot start a transaction before the string pool is read!')
+        self._edits = []
+        self._stringpool.begin()
+        try:
+            yield self
+        except BaseException:
+            self._stringpool.rollback()
+            raise
+        else:
+            self._stringpool.commit()
+            for bytebuffer, data in self._edits:
+                bytebuffer.append(data)
+        finally:
+            self._edits = None
+
+    def _remappable(self):
+        """
+        Whether every string ref of the document lives in the parsed objects. Comments, raw values of non string
+        attributes and unknown chunks are copied verbatim, so their refs can't follow the strings around.
+        """
+        buf = self._buffer
+        root, nul = ResChunk.Header.parsefrom(buf, 0)
+        offset, end = root.headerSize, min(root.chunkSize, len(buf))
+        while offset < end:
+            header, nul = ResChunk.Header.parsefrom(buf, offset, buffer=buf, start=offset)
+            if ResTypes.RES_XML_START_NAMESPACE_TYPE <= header.type <= ResTypes.RES_XML_END_ELEMENT_TYPE:
+                if parsestruct(buf, 'I', offset + 12)[0] != AML.NONE_NAMESPACE_REF:
+                    return False
+                if header.type == ResTypes.RES_XML_START_ELEMENT_TYPE:
+                    attributeStart, attributeSize, attributeCount = parsestruct(buf, 'HHH', header.bodyoffset + 8)
+                    for i in range(attributeCount):
+                        rawvalue, datatype = parsestruct(buf, 'I3xB', header.bodyoffset + attributeStart + i * attributeSize + 8)
+                        if rawvalue != AML.NONE_NAMESPACE_REF and datatype != Res_value.TYPE_STRING:
+                            return False
+            elif header.type not in (ResTypes.RES_STRING_POOL_TYPE, ResTypes.RES_XML_RESOURCE_MAP_TYPE):
+                return False
+            offset = header.nextoffset
+        return True
+
+    def compact(self):
+        """
+        Drops the strings nothing in the document refers to anymore, e.g. leftovers of earlier edits, together with
+        their resource map ids. Returns the number of strings removed, or None if the document holds refs that
+        can't be remapped, in which case the string pool is left alone.
+        """
+        if self.readonly:
+            raise AssertionError('Cannot compact a read-only AML!')
+        if self._edits is not None:
+            raise AssertionError('Cannot compact inside a transaction!')
+        if self._stringpool is None or not self._remappable():
+            return None
+        return self._stringpool.compact(set(self._rootchunk.iterreferences()))
+
+    def iterchunks(self, compact=False):
+        """
+        Yields the serialized document piece by piece, each at most one chunk long.
+        With compact=True the string pool is compacted first, see compact().
+        """
+        if self.readonly:
+            raise AssertionError('Cannot serialize a read-only AML!')
+        if compact:
+            self.compact()
+        return self._rootchunk.iterchunks()
+
+    def writeto(self, fp, compact=False):
+        """
+        Writes the serialized document to a file-like object without building it in memory first.
+        Returns the number of bytes written.
+        """
+        size = 0
+        for i in self.iterchunks(compact):
+            fp.write(i)
+            size += len(i)
+        return size
+
+    def tobytes(self, compact=False):
+        return b''.join(self.iterchunks(compact))
+
+    def iterevents(self):
+        """
+        Yields the original document as libaml.compiler events, so compileevents() builds it again. Attribute values
+        are (dataType, data) tuples, data being the text for strings, and everything is a tuple, which makes the
+        events safe to share.
+        """
+        aml = AML(self._buffer, readonly=True)
+        buf = aml._buffer
+        attributeformat = ResXMLTree_attribute._STRUCT_FORMAT
+        strings = []
+        resourceids = []
+        while aml.hasnext():
+            header, body = aml.next()
+            if header.type == ResTypes.RES_XML_START_ELEMENT_TYPE:
+                ns, name, attributeStart, attributeSize, attributeCount = parsestruct(buf, 'IIHHH', header.bodyoffset)
+                records = AttributeColumns.packrecords(buf, header.bodyoffset + attributeStart, attributeCount,
+                                                       attributeSize)
+                attributes = []
+                for attrns, attrname, rawvalue, size, res0, datatype, data in struct.iter_unpack(attributeformat, records):
+                    if not strings[attrname] and attrname < len(resourceids):
+                        attrname = AML.ResourceMapChunk.ATTRS.getname(resourceids[attrname]) or strings[attrname]
+                    else:
+                        attrname = strings[attrname]
+                    value = (datatype, strings[data] if datatype == Res_value.TYPE_STRING else data)
+                    attributes.append((None if attrns == AML.NONE_NAMESPACE_REF else strings[attrns], attrname, value))
+                yield ('start', None if ns == AML.NONE_NAMESPACE_REF else strings[ns], strings[name],
+                       tuple(attributes), body.node.lineNumber)
+            elif header.type == ResTypes.RES_XML_END_ELEMENT_TYPE:
+                ns, name = parsestruct(buf, 'II', header.bodyoffset)
+                yield ('end', None if ns == AML.NONE_NAMESPACE_REF else strings[ns], strings[name],
+                       body.node.lineNumber)
+            elif header.type == ResTypes.RES_XML_CDATA_TYPE:
+                text = strings[parsestruct(buf, 'I', header.bodyoffset)[0]]
+                yield 'text', text, parsestruct(buf, 'I', header.offset + 8)[0]
+            elif header.type in (ResTypes.RES_XML_START_NAMESPACE_TYPE, ResTypes.RES_XML_END_NAMESPACE_TYPE):
+                kind = 'startns' if header.type == ResTypes.RES_XML_START_NAMESPACE_TYPE else 'endns'
+                yield kind, body.name or None, body.namespace, parsestruct(buf, 'I', header.offset + 8)[0]
+            elif header.type == ResTypes.RES_STRING_POOL_TYPE:
+                strings = list(aml.stringpool.originalstrings)
+            elif header.type == ResTypes.RES_XML_RESOURCE_MAP_TYPE:
+                resourceids = [j for i, j in aml.stringpool.resourcemap.attrs]
+
+    def iterxml(self, indent='  ', table=None):
+        """
+        Yields the document as text XML, about one element at a time. The original document is decoded by a
+        read-only cursor of its own, so this works at any position of this one and ignores edits made through it.
+        With a ResourceTable (see libaml.arsc), references are written by name instead of by id.
+        """
+        aml = AML(self._buffer, readonly=True)
+        buf = aml._buffer
+        escapes = AML.XML_ESCAPES
+        formats = Res_value.FORMATS
+        attributeformat = ResXMLTree_attribute._STRUCT_FORMAT
+        strings = []
+        resourceids = []
+        prefixes = {}
+        declarations = []
+        depth = 0
+        opened = False
+        yield '<?xml version="1.0" encoding="utf-8"?>\n'
+        while aml.hasnext():
+            header, body = aml.next()
+            if header.type == ResTypes.RES_XML_START_ELEMENT_TYPE:
+                ns, name, attributeStart, attributeSize, attributeCount = parsestruct(buf, 'IIHHH', header.bodyoffset)
+                pieces = ['>\n' if opened else '', indent * depth, '<']
+                if ns != AML.NONE_NAMESPACE_REF:
+                    pieces.extend((prefixes.get(strings[ns], strings[ns]), ':'))
+                pieces.append(strings[name])
+                pieces.extend(declarations)
+                declarations = []
+                records = AttributeColumns.packrecords(buf, header.bodyoffset + attributeStart, attributeCount,
+                                                       attributeSize)
+                for ns, name, rawvalue, size, res0, datatype, data in struct.iter_unpack(attributeformat, records):
+                    pieces.append(' ')
+                    if ns != AML.NONE_NAMESPACE_REF:
+                        pieces.extend((prefixes.get(strings[ns], strings[ns]), ':'))
+                    attrname = strings[name]
+                    if not attrname and name < len(resourceids):
+                        attrname = AML.ResourceMapChunk.ATTRS.getname(resourceids[name]) or '%08x' % resourceids[name]
+                    if datatype == Res_value.TYPE_STRING:
+                        value = strings[data].translate(escapes)
+                    elif table is not None and datatype in (Res_value.TYPE_REFERENCE, Res_value.TYPE_ATTRIBUTE):
+                        value = table.formatreference(datatype, data)
+                    elif datatype in formats:
+                        value = formats[datatype](data)
+                    else:
+                        value = '@%08x' % data
+                    pieces.extend((attrname, '="', value, '"'))
+                yield ''.join(pieces)
+                opened = True
+                depth += 1
+            elif header.type == ResTypes.RES_XML_END_ELEMENT_TYPE:
+                depth -= 1
+                if opened:
+                    yield ' />\n'
+                else:
+                    ns, name = parsestruct(buf, 'II', header.bodyoffset)
+                    prefix = '' if ns == AML.NONE_NAMESPACE_REF else prefixes.get(strings[ns], strings[ns]) + ':'
+                    yield '%s</%s%s>\n' % (indent * depth, prefix, strings[name])
+                opened = False
+            elif header.type == ResTypes.RES_XML_CDATA_TYPE:
+                text = strings[parsestruct(buf, 'I', header.bodyoffset)[0]].translate(escapes)
+                yield '%s%s%s\n' % ('>\n' if opened else '', indent * depth, text)
+                opened = False
+            elif header.type == ResTypes.RES_XML_START_NAMESPACE_TYPE:
+                prefixes[body.namespace] = body.name
+                declarations.append(' xmlns:%s="%s"' % (body.name, body.namespace.translate(escapes)))
+            elif header.type == ResTypes.RES_STRING_POOL_TYPE:
+                # Nearly every string ends up in the output, so they are decoded once up front.
+                strings = list(aml.stringpool.originalstrings)
+            elif header.type == ResTypes.RES_XML_RESOURCE_MAP_TYPE:
+                resourceids = [j for i, j in aml.stringpool.resourcemap.attrs]
+
+    def writexml(self, fp, batchsize=256, table=None):
+        """
+        Writes the document as text XML to a text file-like object, batching the pieces of iterxml() into few writes.
+        """
+        pieces = []
+        for i in self.iterxml(table=table):
+            pieces.append(i)
+            if len(pieces) >= batchsize:
+                fp.write(''.join(pieces))
+                pieces = []
+        fp.write(''.join(pieces))
+
+    def toxml(self, table=None):
+        return ''.join(self.iterxml(table=table))
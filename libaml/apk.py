@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module Description:
+Rewrites a single entry of an APK, usually AndroidManifest.xml, without touching the rest of the archive.
+Every other entry is copied with its compressed bytes as they are, only the rewritten entry is inflated and
+deflated again, and the central directory is rebuilt with the new offsets.
+The APK signing block doesn't survive the rewrite, so the result has to be signed again.
+"""
+
+import collections
+import os
+import struct
+import zlib
+
+
+MANIFEST = 'AndroidManifest.xml'
+
+EOCD_FORMAT = '<4s4H2LH'
+CENTRAL_FORMAT = '<4s6H3L5H2L'
+LOCAL_FORMAT = '<4s5H3L2H'
+
+EOCD_SIGNATURE = b'PK\x05\x06'
+CENTRAL_SIGNATURE = b'PK\x01\x02'
+LOCAL_SIGNATURE = b'PK\x03\x04'
+DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+
+FLAG_DATA_DESCRIPTOR = 1 << 3
+FLAG_UTF8 = 1 << 11
+
+STORED = 0
+DEFLATED = 8
+
+COPY_SIZE = 1 << 20
+
+ZipEntry = collections.namedtuple('ZipEntry', ['name', 'central', 'flags', 'method', 'crc', 'compressedsize',
+                                               'size', 'localoffset'])
+
+
+def _readeocd(fp):
+    fp.seek(0, os.SEEK_END)
+    filesize = fp.tell()
+    tailsize = min(filesize, struct.calcsize(EOCD_FORMAT) + 0xffff)
+    fp.seek(filesize - tailsize)
+    tail = fp.read(tailsize)
+    offset = tail.rfind(EOCD_SIGNATURE)
+    if offset < 0:
+        raise AssertionError('Not a zip file!')
+    eocd = struct.unpack_from(EOCD_FORMAT, tail, offset)
+    if eocd[4] == 0xffff or eocd[5] == 0xffffffff or eocd[6] == 0xffffffff:
+        print('Zip64 archives aren\'t supported, sorry')
+        raise NotImplementedError()
+    return eocd, tail[offset + struct.calcsize(EOCD_FORMAT):]
+
+
+def readentries(fp):
+    """Returns the entries of the zip file fp in central directory order."""
+    eocd, comment = _readeocd(fp)
+    fp.seek(eocd[6])
+    directory = fp.read(eocd[5])
+    entries = []
+    offset = 0
+    centralsize = struct.calcsize(CENTRAL_FORMAT)
+    for i in range(eocd[4]):
+        fields = struct.unpack_from(CENTRAL_FORMAT, directory, offset)
+        if fields[0] != CENTRAL_SIGNATURE:
+            raise AssertionError('Broken zip central directory!')
+        flags, method, crc, compressedsize, size, namelen, extralen, commentlen = \
+            fields[3], fields[4], fields[7], fields[8], fields[9], fields[10], fields[11], fields[12]
+        end = offset + centralsize + namelen + extralen + commentlen
+        name = directory[offset + centralsize:offset + centralsize + namelen]
+        name = name.decode('utf-8' if flags & FLAG_UTF8 else 'cp437')
+        entries.append(ZipEntry(name, directory[offset:end], flags, method, crc, compressedsize, size, fields[16]))
+        offset = end
+    return entries
+
+
+def _readlocal(fp, entry):
+    fp.seek(entry.localoffset)
+    local = fp.read(struct.calcsize(LOCAL_FORMAT))
+    fields = struct.unpack(LOCAL_FORMAT, local)
+    if fields[0] != LOCAL_SIGNATURE:
+        raise AssertionError('Broken zip local header!')
+    return local + fp.read(fields[9] + fields[10])
+
+
+def _entrysize(fp, entry, localsize):
+    """The size of an entry's local header, data and data descriptor."""
+    size = localsize + entry.compressedsize
+    if entry.flags & FLAG_DATA_DESCRIPTOR:
+        fp.seek(entry.localoffset + size)
+        size += 16 if fp.read(4) == DESCRIPTOR_SIGNATURE else 12
+    return size
+
+
+def _copy(src, dst, offset, size):
+    src.seek(offset)
+    while size > 0:
+        data = src.read(min(size, COPY_SIZE))
+        if not data:
+            raise AssertionError('Truncated zip file!')
+        dst.write(data)
+        size -= len(data)
+
+
+def _inflate(fp, entry, localsize):
+    fp.seek(entry.localoffset + localsize)
+    data = fp.read(entry.compressedsize)
+    if entry.method == STORED:
+        return data
+    elif entry.method == DEFLATED:
+        return zlib.decompress(data, -zlib.MAX_WBITS)
+    print('Zip compression method %d isn\'t supported, sorry' % entry.method)
+    raise NotImplementedError()
+
+
+def _deflate(data, method):
+    if method == STORED:
+        return data
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def inflateentry(fp, entry):
+    """Returns the uncompressed contents of entry, one of readentries(fp)."""
+    return _inflate(fp, entry, len(_readlocal(fp, entry)))
+
+
+def readentry(path, name=MANIFEST):
+    """Returns the uncompressed contents of the entry name of the APK at path."""
+    with open(path, 'rb') as fp:
+        for entry in readentries(fp):
+            if entry.name == name:
+                return inflateentry(fp, entry)
+    raise KeyError(name)
+
+
+def rewriteentry(inpath, outpath, rewrite, name=MANIFEST, alignment=4):
+    """
+    Writes a copy of the APK at inpath to outpath, with the entry name replaced by rewrite(buf).
+    buf holds the uncompressed entry in a bytearray, so rewrite may either patch it in place and return None
+    (see ResXMLTree_attribute.patch), or return the new contents, e.g. AML(buf).tobytes().
+    Entries stored after the rewritten one keep their alignment as long as it divides alignment, which is 4
+    for zipalign'ed APKs and 4096 for page aligned native libraries.
+    inpath and outpath may be the same file.
+    """
+    with open(inpath, 'rb') as src:
+        entries = readentries(src)
+        eocd, comment = _readeocd(src)
+        if name not in [i.name for i in entries]:
+            raise KeyError(name)
+        order = sorted(range(len(entries)), key=lambda i: entries[i].localoffset)
+        central = [None] * len(entries)
+        temppath = outpath + '.tmp'
+        try:
+            with open(temppath, 'wb') as dst:
+                for position, index in enumerate(order):
+                    entry = entries[index]
+                    local = _readlocal(src, entry)
+                    localoffset = dst.tell()
+                    if entry.name != name:
+                        _copy(src, dst, entry.localoffset, _entrysize(src, entry, len(local)))
+                        central[index] = entry.central[:42] + struct.pack('<L', localoffset) + entry.central[46:]
+                        continue
+                    buf = bytearray(_inflate(src, entry, len(local)))
+                    data = rewrite(buf)
+                    data = bytes(buf) if data is None else bytes(data)
+                    compressed = _deflate(data, entry.method)
+                    crc = zlib.crc32(data) & 0xffffffff
+                    flags = entry.flags & ~FLAG_DATA_DESCRIPTOR
+                    fields = struct.unpack_from(LOCAL_FORMAT, local)
+                    localsize = struct.calcsize(LOCAL_FORMAT)
+                    filename, extra = local[localsize:localsize + fields[9]], local[localsize + fields[9]:]
+                    if position + 1 < len(order):
+                        # Pads the extra field so the entries after this one move by a multiple of alignment.
+                        nextoffset = localoffset + len(local) + len(compressed)
+                        extra += b'\x00' * ((entries[order[position + 1]].localoffset - nextoffset) % alignment)
+                    dst.write(struct.pack(LOCAL_FORMAT, LOCAL_SIGNATURE, fields[1], flags, fields[3], fields[4],
+                                          fields[5], crc, len(compressed), len(data), len(filename), len(extra)))
+                    dst.write(filename)
+                    dst.write(extra)
+                    dst.write(compressed)
+                    fields = list(struct.unpack_from(CENTRAL_FORMAT, entry.central))
+                    fields[3], fields[7], fields[8], fields[9], fields[16] = \
+                        flags, crc, len(compressed), len(data), localoffset
+                    central[index] = struct.pack(CENTRAL_FORMAT, *fields) + entry.central[46:]
+                centraloffset = dst.tell()
+                central = b''.join(central)
+                dst.write(central)
+                dst.write(struct.pack(EOCD_FORMAT, EOCD_SIGNATURE, 0, 0, len(entries), len(entries), len(central),
+                                      centraloffset, len(comment)))
+                dst.write(comment)
+        except BaseException:
+            if os.path.exists(temppath):
+                os.remove(temppath)
+            raise
+    os.replace(temppath, outpath)
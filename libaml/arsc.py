@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module Description:
+Lazy reader of compiled resource tables (resources.arsc).
+One pass over the chunk headers indexes packages, their type/key string pools and the type chunks of every
+configuration. Entries are only located and decoded when a resource id is looked up, and the results are kept
+in an LRU cache.
+"""
+
+import collections
+
+from .aml import AML, ResChunk, ResTypes, Res_value, mapfile, parsestruct
+from .utils.lrucache import LRUCache
+
+
+ResourceEntry = collections.namedtuple('ResourceEntry', ['resid', 'name', 'config', 'value', 'parent', 'bag'])
+
+
+class ResourceTable:
+    # ResTable_type flags
+    FLAG_SPARSE = 0x01
+    FLAG_OFFSET16 = 0x02
+    # ResTable_entry flags
+    FLAG_COMPLEX = 0x01
+    FLAG_COMPACT = 0x08
+    NO_ENTRY = 0xffffffff
+    NO_ENTRY16 = 0xffff
+
+    class Package:
+        def __init__(self, table, header):
+            buf = table._buf
+            # The package fields are part of the chunk header.
+            offset = header.offset + ResChunk.Header.size
+            self.id = parsestruct(buf, 'I', offset)[0]
+            self.name = bytes(buf[offset + 4:offset + 260]).decode('utf-16-le').split('\x00', 1)[0]
+            typestrings, lastpublictype, keystrings = parsestruct(buf, 'III', offset + 260)
+            self.typestrings = AML.StringPoolChunk(buf, header.offset + typestrings).originalstrings
+            self.keystrings = AML.StringPoolChunk(buf, header.offset + keystrings).originalstrings
+            # type id -> offsets of its ResTable_type chunks, one per configuration
+            self.types = {}
+            # type id -> offset of its ResTable_typeSpec chunk
+            self.typespecs = {}
+
+    def __init__(self, buffer, cachesize=4096):
+        """buffer is either the table itself or a path or file descriptor to map it from."""
+        self._buf = buf = memoryview(mapfile(buffer))
+        root, nul = ResChunk.Header.parsefrom(buf, 0)
+        if root.type != ResTypes.RES_TABLE_TYPE:
+            raise AssertionError('Not a resource table!')
+        self._stringpool = None
+        self._packages = {}
+        self._cache = LRUCache(cachesize)
+        offset, end = root.headerSize, min(root.chunkSize, len(buf))
+        while offset < end:
+            header, nul = ResChunk.Header.parsefrom(buf, offset, buffer=buf, start=offset)
+            if header.type == ResTypes.RES_STRING_POOL_TYPE:
+                self._stringpool = AML.StringPoolChunk(buf, offset)
+            elif header.type == ResTypes.RES_TABLE_PACKAGE_TYPE:
+                self._indexpackage(header)
+            offset = header.nextoffset
+
+    def _indexpackage(self, header):
+        buf = self._buf
+        package = ResourceTable.Package(self, header)
+        self._packages[package.id] = package
+        offset, end = header.offset + header.headerSize, header.nextoffset
+        while offset < end:
+            chunk, nul = ResChunk.Header.parsefrom(buf, offset, buffer=buf, start=offset)
+            if chunk.type == ResTypes.RES_TABLE_TYPE_TYPE:
+                package.types.setdefault(buf[offset + ResChunk.Header.size], []).append(offset)
+            elif chunk.type == ResTypes.RES_TABLE_TYPE_SPEC_TYPE:
+                package.typespecs[buf[offset + ResChunk.Header.size]] = offset
+            offset = chunk.nextoffset
+
+    @property
+    def stringpool(self):
+        return self._stringpool
+
+    @property
+    def packages(self):
+        return self._packages
+
+    def _entryoffset(self, typeoffset, index):
+        """Returns the offset of entry index of a ResTable_type chunk, or None if it has no such entry."""
+        buf = self._buf
+        nul, headersize = parsestruct(buf, 'HH', typeoffset)
+        typeid, flags, reserved, entrycount, entriesstart = parsestruct(buf, 'BBHII', typeoffset + 8)
+        offsets = typeoffset + headersize
+        if flags & ResourceTable.FLAG_SPARSE:
+            low, high = 0, entrycount
+            while low < high:
+                middle = (low + high) // 2
+                entryindex, entryoffset = parsestruct(buf, 'HH', offsets + middle * 4)
+                if entryindex == index:
+                    return typeoffset + entriesstart + entryoffset * 4
+                elif entryindex < index:
+                    low = middle + 1
+                else:
+                    high = middle
+            return None
+        if index >= entrycount:
+            return None
+        if flags & ResourceTable.FLAG_OFFSET16:
+            entryoffset = parsestruct(buf, 'H', offsets + index * 2)[0]
+            return None if entryoffset == ResourceTable.NO_ENTRY16 else typeoffset + entriesstart + entryoffset * 4
+        entryoffset = parsestruct(buf, 'I', offsets + index * 4)[0]
+        return None if entryoffset == ResourceTable.NO_ENTRY else typeoffset + entriesstart + entryoffset
+
+    def _readentry(self, resid, package, typeoffset, offset):
+        buf = self._buf
+        size, flags, key = parsestruct(buf, 'HHI', offset)
+        configsize = parsestruct(buf, 'I', typeoffset + 20)[0]
+        config = bytes(buf[typeoffset + 20:typeoffset + 20 + configsize])
+        if flags & ResourceTable.FLAG_COMPACT:
+            value = Res_value.create(8, 0, flags >> 8, key, stringpool=self._stringpool)
+            key = size
+            return ResourceEntry(resid, self._name(package, resid, key), config, value, 0, None)
+        name = self._name(package, resid, key)
+        if flags & ResourceTable.FLAG_COMPLEX:
+            parent, count = parsestruct(buf, 'II', offset + 8)
+            bag = []
+            offset += size
+            for i in range(count):
+                attrid = parsestruct(buf, 'I', offset)[0]
+                value, offset = Res_value.parsefrom(buf, offset + 4, stringpool=self._stringpool)
+                bag.append((attrid, value))
+            return ResourceEntry(resid, name, config, None, parent, tuple(bag))
+        value, nul = Res_value.parsefrom(buf, offset + size, stringpool=self._stringpool)
+        return ResourceEntry(resid, name, config, value, 0, None)
+
+    def _name(self, package, resid, key):
+        return '%s:%s/%s' % (package.name, package.typestrings[((resid >> 16) & 0xff) - 1], package.keystrings[key])
+
+    def getentries(self, resid):
+        """Returns the ResourceEntry of resid for every configuration that defines it."""
+        entries = self._cache.get(resid)
+        if entries is None:
+            entries = []
+            package = self._packages.get(resid >> 24)
+            if package is not None:
+                for typeoffset in package.types.get((resid >> 16) & 0xff, ()):
+                    offset = self._entryoffset(typeoffset, resid & 0xffff)
+                    if offset is not None:
+                        entries.append(self._readentry(resid, package, typeoffset, offset))
+            entries = tuple(entries)
+            self._cache[resid] = entries
+        return entries
+
+    def getentry(self, resid):
+        """Returns the entry of resid for the default configuration, or the first one there is, or None."""
+        entries = self.getentries(resid)
+        for i in entries:
+            if not any(i.config[4:]):
+                return i
+        return entries[0] if entries else None
+
+    def getname(self, resid, package=True):
+        """Returns 'package:type/name' of resid, or 'type/name' without package, or None if it isn't in the table."""
+        entries = self.getentries(resid)
+        if not entries:
+            return None
+        return entries[0].name if package else entries[0].name.split(':', 1)[1]
+
+    def getvalue(self, resid):
+        """Returns the Res_value of resid in the default configuration, or None for bags and unknown ids."""
+        entry = self.getentry(resid)
+        return None if entry is None else entry.value
+
+    def formatreference(self, datatype, data):
+        """Formats a reference or attribute value as @type/name, or ?type/name, if the table knows it."""
+        name = self.getname(data, package=(data >> 24) != 0x7f) if data else None
+        if name is None:
+            return Res_value.formatdata(datatype, data)
+        return ('?' if datatype == Res_value.TYPE_ATTRIBUTE else '@') + name
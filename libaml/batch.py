@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module Description:
+Runs a function over many binary XML documents in a process pool. Inputs are plain AML files or APKs, whose
+manifest and res/ xml entries become one job each. Jobs are sent to the workers in chunks, and results come
+back in input order or as soon as they are done.
+
+Usage:
+python -m libaml.batch [-t manifest|elements|roundtrip] [-j workers] [-c chunksize] [-u] file.xml|app.apk ...
+"""
+
+import collections
+import concurrent.futures
+import getopt
+import itertools
+import os
+import sys
+
+from . import apk
+from .aml import AML, ResTypes, mapfile, parsestruct
+from .manifest import readmanifest
+
+
+BatchResult = collections.namedtuple('BatchResult', ['path', 'entry', 'result', 'error'])
+
+_opened = {}
+
+
+def iterjobs(paths):
+    """Yields a (path, entry) job for every document in paths, entry being None for plain files."""
+    for path in paths:
+        if not path.endswith('.apk'):
+            yield path, None
+            continue
+        with open(path, 'rb') as fp:
+            for entry in apk.readentries(fp):
+                if entry.name == apk.MANIFEST or entry.name.startswith('res/') and entry.name.endswith('.xml'):
+                    yield path, entry.name
+
+
+def readjob(path, entry):
+    if entry is None:
+        return mapfile(path)
+    if path not in _opened:
+        # Every job of an APK needs its central directory, so the last one read is kept around.
+        _opened.clear()
+        with open(path, 'rb') as fp:
+            _opened[path] = dict((i.name, i) for i in apk.readentries(fp))
+    with open(path, 'rb') as fp:
+        return apk.inflateentry(fp, _opened[path][entry])
+
+
+def warmup(initializer=None, initargs=()):
+    """Runs once in every worker: loads the shared attribute tables before the first job needs them."""
+    AML.ResourceMapChunk.REGISTRY.getname(AML.ResourceMapChunk.ATTRS['name'])
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def runjobs(func, jobs):
+    results = []
+    for path, entry in jobs:
+        try:
+            buf = readjob(path, entry)
+            if len(buf) < 8 or parsestruct(buf, 'H')[0] != ResTypes.RES_XML_TYPE:
+                raise AssertionError('Not a binary XML document!')
+            results.append(BatchResult(path, entry, func(buf), None))
+        except Exception as e:
+            results.append(BatchResult(path, entry, None, '%s: %s' % (type(e).__name__, e)))
+    return results
+
+
+def process(func, paths, workers=None, chunksize=16, ordered=True, initializer=None, initargs=()):
+    """
+    Yields a BatchResult for func(buf) over every document of paths, buf being the document's bytes.
+    func has to be picklable, i.e. defined at module level. Failing jobs carry an error message instead of a result.
+    At most a few chunks per worker are in flight at any time, so paths may be a long lazy iterable.
+    """
+    jobs = iterjobs(paths)
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=warmup,
+                                                initargs=(initializer, initargs)) as executor:
+        window = workers * 4
+        pending = collections.deque()
+        while True:
+            while len(pending) < window:
+                chunk = list(itertools.islice(jobs, chunksize))
+                if not chunk:
+                    break
+                pending.append(executor.submit(runjobs, func, chunk))
+            if not pending:
+                break
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = next(concurrent.futures.as_completed(pending))
+                pending.remove(future)
+            for result in future.result():
+                yield result
+
+
+def countelements(buf):
+    aml = AML(buf, readonly=True)
+    count = 0
+    while aml.hasnext():
+        header, body = aml.next()
+        if header.type == ResTypes.RES_XML_START_ELEMENT_TYPE:
+            count += 1
+    return count
+
+
+def roundtrip(buf):
+    aml = AML(buf)
+    while aml.hasnext():
+        aml.next()
+    return aml.tobytes() == memoryview(buf)
+
+
+TASKS = {'manifest': readmanifest, 'elements': countelements, 'roundtrip': roundtrip}
+
+
+if __name__ == '__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 't:j:c:u')
+    params = dict([(i.lstrip('-'), j) for i, j in opts])
+
+    if not args or params.get('t', 'manifest') not in TASKS:
+        print('Usage:\n%s [-t %s] [-j workers] [-c chunksize] [-u] file.xml|app.apk ...'
+              % (sys.argv[0], '|'.join(sorted(TASKS))))
+        sys.exit(0)
+
+    results = process(TASKS[params.get('t', 'manifest')], args, int(params['j']) if 'j' in params else None,
+                      int(params.get('c', 16)), 'u' not in params)
+    for result in results:
+        name = result.path if result.entry is None else '%s!%s' % (result.path, result.entry)
+        print('%s\t%s' % (name, result.result if result.error is None else result.error))
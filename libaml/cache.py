@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module Description:
+Caches what is decoded from binary XML documents under a hash of their bytes, so documents that show up again,
+like the same layouts across many builds of an APK, are never parsed twice.
+Results live in a size bounded LRU in memory and, given a directory, in marshal files on disk that are shared by
+every process and run using the same directory. Unlike pickle, loading marshal data never runs code, so a file
+planted in a shared directory can at worst yield a wrong result.
+"""
+
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+from .aml import AML, ResChunk, ResTypes, mapfile
+from .manifest import ManifestSummary, readmanifest
+from .utils.lrucache import LRUCache
+
+
+def readstrings(buf):
+    """Returns the decoded string pool of a document as a tuple."""
+    root, nul = ResChunk.Header.parsefrom(buf, 0)
+    offset, end = root.headerSize, min(root.chunkSize, len(buf))
+    while offset < end:
+        header, nul = ResChunk.Header.parsefrom(buf, offset)
+        if header.type == ResTypes.RES_STRING_POOL_TYPE:
+            return tuple(AML.StringPoolChunk(buf, offset).originalstrings)
+        offset += header.chunkSize
+    return ()
+
+
+def readevents(buf):
+    """Returns the document as a tuple of libaml.compiler events, see AML.iterevents()."""
+    return tuple(AML(buf, readonly=True).iterevents())
+
+
+def sizeof(value):
+    """The memory taken by value and everything in the tuples, lists and dicts it holds, shared objects included."""
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum([sizeof(i) for i in value])
+    elif isinstance(value, dict):
+        size += sum([sizeof(i) + sizeof(j) for i, j in value.items()])
+    return size
+
+
+class ParseCache:
+    # Eviction trims the directory to this share of disksize, so it only runs once every many stores.
+    DISK_LOW_WATERMARK = 0.75
+
+    KINDS = {'strings': readstrings, 'events': readevents, 'manifest': readmanifest}
+    # Named tuples are stored as plain tuples, marshal only takes builtin types.
+    ROWTYPES = {'manifest': ManifestSummary}
+
+    def __init__(self, maxsize=64 << 20, directory=None, disksize=1 << 30):
+        """
+        maxsize bounds the memory taken by the results kept in memory, see sizeof(), and disksize the total size
+        of the files kept in directory. Without a directory nothing is written to disk.
+        """
+        self._memory = LRUCache(maxsize, sizeof=lambda item: item[0])
+        self._directory = directory
+        self._disksize = disksize
+        self._disktotal = 0
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._disktotal = sum([i[1] for i in self._scan()])
+
+    @staticmethod
+    def hash(buf):
+        return hashlib.blake2b(buf, digest_size=16).hexdigest()
+
+    def _path(self, digest, kind):
+        return os.path.join(self._directory, '%s.%s' % (digest, kind))
+
+    def _load(self, digest, kind):
+        try:
+            with open(self._path(digest, kind), 'rb') as fp:
+                value = marshal.load(fp)
+            if kind in ParseCache.ROWTYPES:
+                value = ParseCache.ROWTYPES[kind](*value)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        # The access time may not be tracked, so the modification time is what orders the files for eviction.
+        os.utime(self._path(digest, kind))
+        return value
+
+    def _store(self, digest, kind, value):
+        fd, temppath = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            marshal.dump(tuple(value) if kind in ParseCache.ROWTYPES else value, fp)
+            self._disktotal += fp.tell()
+        os.replace(temppath, self._path(digest, kind))
+        # The total is kept as files are written, and only rescanned on eviction, which also picks up what other
+        # processes sharing the directory wrote in between.
+        if self._disktotal > self._disksize:
+            self._evict()
+
+    def _scan(self):
+        files = []
+        for entry in os.scandir(self._directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _evict(self):
+        files = self._scan()
+        size = sum([i[1] for i in files])
+        for mtime, filesize, path in sorted(files):
+            if size <= self._disksize * ParseCache.DISK_LOW_WATERMARK:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= filesize
+        self._disktotal = size
+
+    def get(self, buffer, kind='events'):
+        """
+        Returns KINDS[kind] of the document given as a buffer, a path or a file descriptor, from the cache if the
+        same bytes were seen before. Results are shared between callers and must not be modified.
+        """
+        buf = memoryview(mapfile(buffer))
+        digest = ParseCache.hash(buf)
+        item = self._memory.get((digest, kind))
+        if item is not None:
+            self.hits += 1
+            return item[1]
+        value = None if self._directory is None else self._load(digest, kind)
+        if value is None:
+            self.misses += 1
+            value = ParseCache.KINDS[kind](buf)
+            if self._directory is not None:
+                self._store(digest, kind, value)
+        else:
+            self.hits += 1
+        self._memory[(digest, kind)] = (sizeof(value), value)
+        return value
+
+    def strings(self, buffer):
+        return self.get(buffer, 'strings')
+
+    def events(self, buffer):
+        return self.get(buffer, 'events')
+
+    def manifest(self, buffer):
+        return self.get(buffer, 'manifest')
+
+    def clear(self):
+        self._memory.clear()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module Description:
+Compiles text XML, or a stream of SAX style events, into a standalone binary XML document.
+The first pass collects the string pool and the resource map and sizes every chunk, the second one packs the
+chunks with precompiled structs into a single preallocated bytearray.
+
+Events are tuples of:
+('startns', prefix, uri, line), ('endns', prefix, uri, line),
+('start', ns, name, attributes, line) with attributes a list of (ns, name, value),
+('end', ns, name, line) and ('text', text, line),
+ns being None for names without namespace. Attribute values are either typed already (bool, int, float or a
+(dataType, data) tuple) or text, which is typed the way aapt reads literals and common enum and flag symbols
+for attributes of the android namespace, and kept as a string for every other attribute.
+"""
+
+import functools
+import re
+import struct
+import xml.parsers.expat
+
+from .aml import AML, Res_value, ResTypes
+
+
+HEADER = struct.Struct('HHI')
+STRINGPOOL = struct.Struct('HHI5I')
+NODE = struct.Struct('HHIII')
+NAMESPACE = struct.Struct('HHIIIII')
+STARTELEMENT = struct.Struct('HHIIIIIHHHHHH')
+ATTRIBUTE = struct.Struct('IIIHBBI')
+ENDELEMENT = struct.Struct('HHIIIII')
+CDATA = struct.Struct('HHIIIIHBBI')
+
+# android attributes of string format that often hold text that looks like a number.
+STRING_ATTRS = frozenset(['versionName', 'name', 'label', 'description', 'text', 'hint', 'contentDescription',
+                          'title', 'summary', 'authorities', 'scheme', 'host', 'port', 'path', 'pathPrefix',
+                          'pathPattern', 'mimeType', 'permission', 'process', 'taskAffinity', 'targetPackage',
+                          'sharedUserId', 'compileSdkVersionCodename'])
+
+# android attributes that take any text when it isn't a literal of one of their other formats.
+TEXT_ATTRS = frozenset(['value', 'tag', 'targetActivity', 'parentActivityName', 'backupAgent', 'appComponentFactory',
+                        'requiredAccountType', 'restrictedAccountType', 'requiredSystemPropertyName',
+                        'requiredSystemPropertyValue', 'ssp', 'sspPrefix', 'sspPattern', 'pathSuffix',
+                        'pathAdvancedPattern'])
+
+# Symbols of common android enum attributes, written as TYPE_INT_DEC.
+_GRAVITY = {'top': 0x30, 'bottom': 0x50, 'left': 0x03, 'right': 0x05, 'center_vertical': 0x10,
+            'fill_vertical': 0x70, 'center_horizontal': 0x01, 'fill_horizontal': 0x07, 'center': 0x11, 'fill': 0x77,
+            'clip_vertical': 0x80, 'clip_horizontal': 0x08, 'start': 0x00800003, 'end': 0x00800005}
+_LAYOUT_SIZE = {'fill_parent': -1, 'match_parent': -1, 'wrap_content': -2}
+ENUM_ATTRS = {
+    'launchMode': {'standard': 0, 'singleTop': 1, 'singleTask': 2, 'singleInstance': 3, 'singleInstancePerTask': 4},
+    'screenOrientation': {'unspecified': -1, 'landscape': 0, 'portrait': 1, 'user': 2, 'behind': 3, 'sensor': 4,
+                          'nosensor': 5, 'sensorLandscape': 6, 'sensorPortrait': 7, 'reverseLandscape': 8,
+                          'reversePortrait': 9, 'fullSensor': 10, 'userLandscape': 11, 'userPortrait': 12,
+                          'fullUser': 13, 'locked': 14},
+    'documentLaunchMode': {'none': 0, 'intoExisting': 1, 'always': 2, 'never': 3},
+    'installLocation': {'auto': 0, 'internalOnly': 1, 'preferExternal': 2},
+    'orientation': {'horizontal': 0, 'vertical': 1},
+    'visibility': {'visible': 0, 'invisible': 1, 'gone': 2},
+    'layout_width': _LAYOUT_SIZE,
+    'layout_height': _LAYOUT_SIZE,
+}
+# Symbols of common android flag attributes, joined with | and written as TYPE_INT_HEX.
+FLAG_ATTRS = {
+    'protectionLevel': {'normal': 0, 'dangerous': 1, 'signature': 2, 'signatureOrSystem': 3, 'privileged': 0x10,
+                        'system': 0x10, 'development': 0x20, 'appop': 0x40, 'pre23': 0x80, 'installer': 0x100,
+                        'verifier': 0x200, 'preinstalled': 0x400, 'setup': 0x800, 'instant': 0x1000,
+                        'runtime': 0x2000},
+    'windowSoftInputMode': {'stateUnspecified': 0, 'stateUnchanged': 1, 'stateHidden': 2, 'stateAlwaysHidden': 3,
+                            'stateVisible': 4, 'stateAlwaysVisible': 5, 'adjustUnspecified': 0, 'adjustResize': 0x10,
+                            'adjustPan': 0x20, 'adjustNothing': 0x30},
+    'configChanges': {'mcc': 0x1, 'mnc': 0x2, 'locale': 0x4, 'touchscreen': 0x8, 'keyboard': 0x10,
+                      'keyboardHidden': 0x20, 'navigation': 0x40, 'orientation': 0x80, 'screenLayout': 0x100,
+                      'uiMode': 0x200, 'screenSize': 0x400, 'smallestScreenSize': 0x800, 'density': 0x1000,
+                      'layoutDirection': 0x2000, 'colorMode': 0x4000, 'fontWeightAdjustment': 0x10000000,
+                      'fontScale': 0x40000000},
+    'gravity': _GRAVITY,
+    'layout_gravity': _GRAVITY,
+}
+
+DIMENSION_PATTERN = re.compile(r'^([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)(px|dip|dp|sp|pt|in|mm|%p|%)$')
+RESOURCE_PATTERN = re.compile(r'^([@?])(?:0x)?([0-9a-fA-F]{8})$')
+COLOR_TYPES = {3: Res_value.TYPE_INT_COLOR_RGB4, 4: Res_value.TYPE_INT_COLOR_ARGB4,
+               6: Res_value.TYPE_INT_COLOR_RGB8, 8: Res_value.TYPE_INT_COLOR_ARGB8}
+COMPLEX_UNITS = {'px': 0, 'dip': 1, 'dp': 1, 'sp': 2, 'pt': 3, 'in': 4, 'mm': 5, '%': 0, '%p': 1}
+
+
+def _complex(value, unit):
+    """Encodes value with the smallest radix that keeps its precision, like aapt's floatToComplex."""
+    if unit in ('%', '%p'):
+        value /= 100.0
+    neg = value < 0
+    if neg:
+        value = -value
+    bits = int(value * (1 << 23) + 0.5)
+    if bits & 0x7fffff == 0:
+        radix, mantissa = 0, bits >> 23
+    elif bits & ~0x7fffff == 0:
+        radix, mantissa = 3, bits
+    elif bits & ~0x7fffffff == 0:
+        radix, mantissa = 2, bits >> 8
+    elif bits & ~0x7fffffffff == 0:
+        radix, mantissa = 1, bits >> 16
+    else:
+        radix, mantissa = 0, bits >> 23
+    if neg:
+        mantissa = -mantissa
+    return ((mantissa & 0xffffff) << 8 | radix << 4 | COMPLEX_UNITS[unit]) & 0xffffffff
+
+
+@functools.lru_cache(maxsize=4096)
+def parsevalue(text):
+    """Types a literal attribute value, returning (dataType, data), or None for strings. Results are memoized."""
+    if text in ('true', 'false'):
+        return Res_value.TYPE_INT_BOOLEAN, 0xffffffff if text == 'true' else 0
+    if text == '@null':
+        return Res_value.TYPE_REFERENCE, 0
+    if text == '@empty':
+        return Res_value.TYPE_NULL, 1
+    if text[:1] in ('@', '?'):
+        match = RESOURCE_PATTERN.match(text)
+        if match is None:
+            return None
+        return Res_value.TYPE_REFERENCE if match.group(1) == '@' else Res_value.TYPE_ATTRIBUTE, int(match.group(2), 16)
+    if text[:1] == '#':
+        digits = text[1:]
+        if len(digits) not in COLOR_TYPES or re.match(r'^[0-9a-fA-F]+$', digits) is None:
+            return None
+        if len(digits) <= 4:
+            digits = ''.join([i * 2 for i in digits])
+        return COLOR_TYPES[len(text) - 1], int(digits, 16) | (0 if len(digits) == 8 else 0xff000000)
+    if text[:2] in ('0x', '0X'):
+        try:
+            return Res_value.TYPE_INT_HEX, int(text, 16) & 0xffffffff
+        except ValueError:
+            return None
+    try:
+        return Res_value.TYPE_INT_DEC, int(text, 10) & 0xffffffff
+    except ValueError:
+        pass
+    match = DIMENSION_PATTERN.match(text)
+    if match is not None:
+        unit = match.group(2)
+        datatype = Res_value.TYPE_FRACTION if unit in ('%', '%p') else Res_value.TYPE_DIMENSION
+        return datatype, _complex(float(match.group(1)), unit)
+    try:
+        return Res_value.TYPE_FLOAT, struct.unpack('I', struct.pack('f', float(text)))[0]
+    except (ValueError, OverflowError):
+        return None
+
+
+def parsesymbols(name, text):
+    """Types the enum or flag symbols of a known android attribute, returning (dataType, data), or None."""
+    if name in ENUM_ATTRS:
+        symbols = ENUM_ATTRS[name]
+        if text in symbols:
+            return Res_value.TYPE_INT_DEC, symbols[text] & 0xffffffff
+    elif name in FLAG_ATTRS:
+        symbols = FLAG_ATTRS[name]
+        data = 0
+        for i in text.split('|'):
+            if i.strip() not in symbols:
+                return None
+            data |= symbols[i.strip()]
+        return Res_value.TYPE_INT_HEX, data
+    return None
+
+
+def typevalue(ns, name, value):
+    """
+    Returns (dataType, data, string) of an attribute value, string being None unless it is a string.
+    Text of an android attribute that is neither a literal, a known symbol nor one of the attributes taking text
+    raises: the attribute format isn't known here, and writing it as a string would silently change its meaning.
+    (Res_value.TYPE_STRING, text) forces a string.
+    """
+    if type(value) is tuple:
+        if value[0] == Res_value.TYPE_STRING:
+            return Res_value.TYPE_STRING, 0, value[1]
+        return value[0], value[1], None
+    elif type(value) is bool:
+        return Res_value.TYPE_INT_BOOLEAN, 0xffffffff if value else 0, None
+    elif type(value) is int:
+        return Res_value.TYPE_INT_DEC, value & 0xffffffff, None
+    elif type(value) is float:
+        return Res_value.TYPE_FLOAT, struct.unpack('I', struct.pack('f', value))[0], None
+    if ns == AML.ANDROID_NAMESPACE and value[:1] in ('@', '?'):
+        # Even attributes of string format mostly hold references, e.g. android:label="@7f0a0001".
+        typed = parsevalue(value)
+        if typed is not None:
+            return typed[0], typed[1], None
+    if ns == AML.ANDROID_NAMESPACE and name not in STRING_ATTRS:
+        typed = parsevalue(value) or parsesymbols(name, value)
+        if typed is not None:
+            return typed[0], typed[1], None
+        if name not in TEXT_ATTRS:
+            print("Couldn't type android:%s=\"%s\", pass it as (dataType, data)" % (name, value))
+            raise NotImplementedError()
+    return Res_value.TYPE_STRING, 0, value
+
+
+def iterevents(source):
+    """Parses text XML given as str or bytes into compiler events."""
+    events = []
+    parser = xml.parsers.expat.ParserCreate(namespace_separator=' ')
+
+    def splitname(name):
+        if ' ' in name:
+            return tuple(name.split(' ', 1))
+        return None, name
+
+    def startelement(name, attrs):
+        attributes = [splitname(k) + (v,) for k, v in zip(attrs[::2], attrs[1::2])]
+        events.append(('start',) + splitname(name) + (attributes, parser.CurrentLineNumber))
+
+    parser.ordered_attributes = True
+    parser.StartNamespaceDeclHandler = lambda prefix, uri: events.append(('startns', prefix, uri,
+                                                                          parser.CurrentLineNumber))
+    parser.EndNamespaceDeclHandler = lambda prefix: events.append(('endns', prefix, None, parser.CurrentLineNumber))
+    parser.StartElementHandler = startelement
+    parser.EndElementHandler = lambda name: events.append(('end',) + splitname(name) + (parser.CurrentLineNumber,))
+    parser.CharacterDataHandler = lambda text: events.append(('text', text, parser.CurrentLineNumber))
+    parser.Parse(source, True)
+    return iter(events)
+
+
+def _mergetext(events):
+    """Joins adjacent text events and drops whitespace-only text, as aapt does."""
+    text = []
+    for event in events:
+        if event[0] == 'text':
+            text.append(event)
+            continue
+        if text:
+            joined = ''.join([i[1] for i in text])
+            if joined.strip():
+                yield 'text', joined, text[0][2]
+            text = []
+        yield event
+    if text:
+        joined = ''.join([i[1] for i in text])
+        if joined.strip():
+            yield 'text', joined, text[0][2]
+
+
+def compileevents(events, utf8=True, apilevel=None):
+    """Compiles compiler events into a binary XML document, returned as a bytearray."""
+    registry = AML.ResourceMapChunk.REGISTRY
+    attrids = {}
+    strings = {}
+    prepared = []
+    namespaces = []
+    size = HEADER.size
+    for event in _mergetext(events):
+        kind = event[0]
+        if kind == 'startns':
+            namespaces.append(event[1:3])
+            strings.setdefault(event[1] or '', None)
+            strings.setdefault(event[2], None)
+            prepared.append(event)
+            size += NAMESPACE.size
+        elif kind == 'endns':
+            prefix, uri = namespaces.pop()
+            prepared.append(('endns', prefix, uri, event[3]))
+            size += NAMESPACE.size
+        elif kind == 'start':
+            ns, name, attributes, line = event[1:]
+            if ns is not None:
+                strings.setdefault(ns, None)
+            strings.setdefault(name, None)
+            typed = []
+            for attrns, attrname, value in attributes:
+                attrid = None
+                if attrns == AML.ANDROID_NAMESPACE:
+                    attrid = registry.getattrid(attrname, apilevel)
+                    if attrid is None:
+                        print("Couldn't find R.attr.%s value" % attrname)
+                        raise NotImplementedError()
+                    attrids[attrname] = attrid
+                typed.append((attrid, attrns, attrname) + typevalue(attrns, attrname, value))
+            # Attributes are looked up by binary search on their resource id, the ones without come last.
+            typed.sort(key=lambda i: (0, i[0], '', '') if i[0] is not None else (1, 0, i[1] or '', i[2]))
+            for attrid, attrns, attrname, datatype, data, string in typed:
+                if attrns is not None:
+                    strings.setdefault(attrns, None)
+                if attrid is None:
+                    strings.setdefault(attrname, None)
+                if string is not None:
+                    strings.setdefault(string, None)
+            prepared.append(('start', ns, name, typed, line))
+            size += STARTELEMENT.size + ATTRIBUTE.size * len(typed)
+        elif kind == 'end':
+            prepared.append(event)
+            size += ENDELEMENT.size
+        elif kind == 'text':
+            strings.setdefault(event[1], None)
+            prepared.append(event)
+            size += CDATA.size
+
+    # Attribute names with a resource id come first, in id order, so the resource map lines up with the pool.
+    attrnames = sorted(attrids, key=lambda i: attrids[i])
+    pool = attrnames + [i for i in strings if i not in attrids]
+    refs = dict((j, i) for i, j in enumerate(pool))
+    encode = AML.StringPoolChunk._UTF8StringList.encode if utf8 else AML.StringPoolChunk._UTF16StringList.encode
+    encoded = [encode(i) for i in pool]
+    stringsstart = STRINGPOOL.size + 4 * len(pool)
+    stringssize = sum([len(i) for i in encoded])
+    poolsize = stringsstart + stringssize + (4 - stringssize % 4) % 4
+    mapsize = HEADER.size + 4 * len(attrnames)
+    size += poolsize + mapsize
+
+    buf = bytearray(size)
+    HEADER.pack_into(buf, 0, ResTypes.RES_XML_TYPE, HEADER.size, size)
+    offset = HEADER.size
+    STRINGPOOL.pack_into(buf, offset, ResTypes.RES_STRING_POOL_TYPE, STRINGPOOL.size, poolsize, len(pool), 0,
+                         AML.StringPoolChunk.UTF8_FLAG if utf8 else 0, stringsstart, 0)
+    stringoffsets = []
+    stringoffset = 0
+    for i in encoded:
+        stringoffsets.append(stringoffset)
+        stringoffset += len(i)
+    struct.pack_into('%dI' % len(pool), buf, offset + STRINGPOOL.size, *stringoffsets)
+    buf[offset + stringsstart:offset + stringsstart + stringssize] = b''.join(encoded)
+    offset += poolsize
+    HEADER.pack_into(buf, offset, ResTypes.RES_XML_RESOURCE_MAP_TYPE, HEADER.size, mapsize)
+    struct.pack_into('%dI' % len(attrnames), buf, offset + HEADER.size, *[attrids[i] for i in attrnames])
+    offset += mapsize
+
+    none = AML.NONE_NAMESPACE_REF
+    for event in prepared:
+        kind = event[0]
+        if kind == 'startns' or kind == 'endns':
+            chunktype = ResTypes.RES_XML_START_NAMESPACE_TYPE if kind == 'startns' else ResTypes.RES_XML_END_NAMESPACE_TYPE
+            NAMESPACE.pack_into(buf, offset, chunktype, NODE.size, NAMESPACE.size, event[3], none,
+                                refs[event[1] or ''], refs[event[2]])
+            offset += NAMESPACE.size
+        elif kind == 'start':
+            ns, name, typed, line = event[1:]
+            idindex = classindex = styleindex = 0
+            for i, (attrid, attrns, attrname, datatype, data, string) in enumerate(typed):
+                if attrns == AML.ANDROID_NAMESPACE and attrname == 'id':
+                    idindex = i + 1
+                elif attrns is None and attrname == 'class':
+                    classindex = i + 1
+                elif attrns is None and attrname == 'style':
+                    styleindex = i + 1
+            STARTELEMENT.pack_into(buf, offset, ResTypes.RES_XML_START_ELEMENT_TYPE, NODE.size,
+                                   STARTELEMENT.size + ATTRIBUTE.size * len(typed), line, none,
+                                   none if ns is None else refs[ns], refs[name], 20, ATTRIBUTE.size, len(typed),
+                                   idindex, classindex, styleindex)
+            offset += STARTELEMENT.size
+            for attrid, attrns, attrname, datatype, data, string in typed:
+                if string is not None:
+                    rawvalue = data = refs[string]
+                else:
+                    rawvalue = none
+                ATTRIBUTE.pack_into(buf, offset, none if attrns is None else refs[attrns], refs[attrname], rawvalue,
+                                    8, 0, datatype, data)
+                offset += ATTRIBUTE.size
+        elif kind == 'end':
+            ns, name, line = event[1:]
+            ENDELEMENT.pack_into(buf, offset, ResTypes.RES_XML_END_ELEMENT_TYPE, NODE.size, ENDELEMENT.size, line,
+                                 none, none if ns is None else refs[ns], refs[name])
+            offset += ENDELEMENT.size
+        elif kind == 'text':
+            CDATA.pack_into(buf, offset, ResTypes.RES_XML_CDATA_TYPE, NODE.size, CDATA.size, event[2], none,
+                            refs[event[1]], 8, 0, Res_value.TYPE_STRING, refs[event[1]])
+            offset += CDATA.size
+    return buf
+
+
+def compilexml(source, utf8=True, apilevel=None):
+    """Compiles text XML, given as str or bytes, into a binary XML document returned as a bytearray."""
+    return compileevents(iterevents(source), utf8, apilevel)
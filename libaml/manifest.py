@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module Description:
+Read-only fast path pulling the package identity out of a binary AndroidManifest.xml.
+It walks chunk headers by offset, never builds the AML rewrite buffer, and only parses the manifest element and
+its direct children.
+"""
+
+import collections
+import ctypes
+
+from .aml import AML, ResChunk, ResTypes, Res_value, mapfile, parsestruct
+
+
+ManifestSummary = collections.namedtuple('ManifestSummary', ['package', 'versionCode', 'versionName',
+                                                             'minSdkVersion', 'targetSdkVersion', 'permissions'])
+
+SUMMARY_ATTRS = ('versionCode', 'versionName', 'minSdkVersion', 'targetSdkVersion', 'name')
+
+
+def _attrvalue(strings, rawvalue, datatype, data):
+    if datatype == Res_value.TYPE_STRING:
+        return strings[data if data != AML.NONE_NAMESPACE_REF else rawvalue]
+    elif Res_value.TYPE_FIRST_INT <= datatype <= Res_value.TYPE_LAST_INT:
+        if datatype == Res_value.TYPE_INT_BOOLEAN:
+            return data != 0
+        return ctypes.c_int32(data).value
+    elif rawvalue != AML.NONE_NAMESPACE_REF:
+        return strings[rawvalue]
+    return data
+
+
+def _readattributes(buf, header, strings, attrids):
+    """Returns {attribute name: value} of a start element, naming attributes by resource id where possible."""
+    attributes = {}
+    ns, name, attributeStart, attributeSize, attributeCount = parsestruct(buf, 'IIHHH', header.bodyoffset)
+    offset = header.bodyoffset + attributeStart
+    for i in range(attributeCount):
+        ns, name, rawvalue, size, res0, datatype, data = parsestruct(buf, 'IIIHBBI', offset)
+        attrname = attrids.get(name) or strings[name]
+        attributes[attrname] = _attrvalue(strings, rawvalue, datatype, data)
+        offset += attributeSize
+    return attributes
+
+
+def _skipsubtree(buf, offset, end):
+    """Returns the offset after the end of the element starting at offset, reading only chunk types and sizes."""
+    depth = 0
+    while offset < end:
+        chunktype, headersize, chunksize = parsestruct(buf, 'HHI', offset)
+        if chunktype == ResTypes.RES_XML_START_ELEMENT_TYPE:
+            depth += 1
+        elif chunktype == ResTypes.RES_XML_END_ELEMENT_TYPE:
+            depth -= 1
+        if chunksize < headersize or chunksize < 8:
+            raise AssertionError('Bad chunk size %d at %d!' % (chunksize, offset))
+        offset += chunksize
+        if depth == 0:
+            break
+    return offset
+
+
+def readmanifest(buffer, stopatapplication=False):
+    """
+    Returns the ManifestSummary of a binary AndroidManifest.xml, given as a buffer, a path or a file descriptor.
+
+    The <application> subtree is skipped by chunk header, and manifest-level elements after it are still read,
+    since aapt keeps them in source order. Pass stopatapplication=True to stop at <application> instead, which only
+    gives a complete summary for manifests that put it last.
+    """
+    buf = memoryview(mapfile(buffer))
+    root, nul = ResChunk.Header.parsefrom(buf, 0)
+    offset, end = root.headerSize, min(root.chunkSize, len(buf))
+    strings = None
+    attrids = {}
+    depth = 0
+    values = {'permissions': []}
+    while offset < end:
+        header, nul = ResChunk.Header.parsefrom(buf, offset, buffer=buf, start=offset)
+        if header.type == ResTypes.RES_XML_START_ELEMENT_TYPE:
+            depth += 1
+            if depth <= 2:
+                elementname = strings[parsestruct(buf, 'I', header.bodyoffset + 4)[0]]
+                if depth == 2 and elementname == 'application':
+                    if stopatapplication:
+                        break
+                    depth -= 1
+                    offset = _skipsubtree(buf, offset, end)
+                    continue
+                if depth == 1 and elementname == 'manifest':
+                    attributes = _readattributes(buf, header, strings, attrids)
+                    values['package'] = attributes.get('package')
+                    values['versionCode'] = attributes.get('versionCode')
+                    values['versionName'] = attributes.get('versionName')
+                elif depth == 2 and elementname == 'uses-sdk':
+                    attributes = _readattributes(buf, header, strings, attrids)
+                    values['minSdkVersion'] = attributes.get('minSdkVersion')
+                    values['targetSdkVersion'] = attributes.get('targetSdkVersion')
+                elif depth == 2 and elementname == 'uses-permission':
+                    attributes = _readattributes(buf, header, strings, attrids)
+                    if 'name' in attributes:
+                        values['permissions'].append(attributes['name'])
+        elif header.type == ResTypes.RES_XML_END_ELEMENT_TYPE:
+            depth -= 1
+        elif header.type == ResTypes.RES_STRING_POOL_TYPE:
+            strings = AML.StringPoolChunk(buf, offset).originalstrings
+        elif header.type == ResTypes.RES_XML_RESOURCE_MAP_TYPE:
+            ids = parsestruct(buf, str((header.chunkSize - header.headerSize) // 4) + 'I', header.bodyoffset)
+            names = [AML.ResourceMapChunk.ATTRS.getname(i) for i in ids]
+            attrids = dict((i, j) for i, j in enumerate(names) if j in SUMMARY_ATTRS)
+        offset = header.nextoffset
+    return ManifestSummary(values.get('package'), values.get('versionCode'), values.get('versionName'),
+                           values.get('minSdkVersion'), values.get('targetSdkVersion'), tuple(values['permissions']))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module Description:
+Path selectors over binary XML, e.g. manifest/application/activity[@android:exported=true].
+A selector is parsed once, and bound to the string pool of each document it runs on, so element and attribute
+names become sets of string refs and literal values become raw typed values. Matching then takes integer
+compares on the chunk records, during a single pass of an AML cursor.
+
+Syntax:
+Steps are element names or *, separated by / for children or // for descendants. A leading / changes nothing,
+selectors always start at the document, and a leading // matches at any depth.
+Each step takes any number of [@name], [@prefix:name] or [@prefix:name=value] predicates. An attribute without
+prefix may have any namespace. Values in quotes are strings, other values are read like aapt reads attribute
+literals (true, 41, 0x10, #ff00ff00, @7f010000, 16dp) and compared by type and data.
+"""
+
+import collections
+import re
+
+from .aml import AML, ResTypes, Res_value, parsestruct
+from .compiler import parsevalue
+from .tree import valuematcher
+
+
+STEP_PATTERN = re.compile(r'\s*([\w.$-]+|\*)\s*')
+PREDICATE_PATTERN = re.compile(r'\[\s*@(?:([\w.-]+):)?([\w.-]+)\s*(?:=\s*(\'[^\']*\'|"[^"]*"|[^\]\s]+)\s*)?\]\s*')
+
+Step = collections.namedtuple('Step', ['descendant', 'name', 'predicates'])
+Predicate = collections.namedtuple('Predicate', ['prefix', 'name', 'value'])
+
+
+def _literal(text):
+    """Returns the value a predicate compares against: str, bool, int or a (dataType, data) tuple."""
+    if text[:1] in ('"', "'"):
+        return text[1:-1]
+    typed = parsevalue(text)
+    if typed is None:
+        return text
+    datatype, data = typed
+    if datatype == Res_value.TYPE_INT_BOOLEAN:
+        return data != 0
+    elif datatype in (Res_value.TYPE_INT_DEC, Res_value.TYPE_INT_HEX):
+        return data
+    return typed
+
+
+class Selector:
+    def __init__(self, expression):
+        self._expression = expression
+        self._steps = []
+        offset = 0
+        descendant = False
+        if expression.startswith('//'):
+            offset, descendant = 2, True
+        elif expression.startswith('/'):
+            offset = 1
+        while True:
+            match = STEP_PATTERN.match(expression, offset)
+            if match is None:
+                raise AssertionError('Bad selector step at %d of %s!' % (offset, expression))
+            name = None if match.group(1) == '*' else match.group(1)
+            offset = match.end()
+            predicates = []
+            match = PREDICATE_PATTERN.match(expression, offset)
+            while match is not None:
+                value = None if match.group(3) is None else _literal(match.group(3))
+                predicates.append(Predicate(match.group(1), match.group(2), value))
+                offset = match.end()
+                match = PREDICATE_PATTERN.match(expression, offset)
+            self._steps.append(Step(descendant, name, tuple(predicates)))
+            if offset == len(expression):
+                break
+            if expression.startswith('//', offset):
+                offset, descendant = offset + 2, True
+            elif expression.startswith('/', offset):
+                offset, descendant = offset + 1, False
+            else:
+                raise AssertionError('Bad selector at %d of %s!' % (offset, expression))
+
+    @property
+    def expression(self):
+        return self._expression
+
+    @property
+    def steps(self):
+        return self._steps
+
+    def compile(self, aml):
+        """
+        Binds the steps to the string pool, resource map and namespaces aml has read so far. Returns a list of
+        (descendant, name refs, [(namespace refs, name refs, value test)]), refs being None where anything matches,
+        or None if some step can't match anything in this document.
+        """
+        strings = list(aml.stringpool.originalstrings)
+        resourceids = [] if aml.stringpool.resourcemap is None else [j for i, j in aml.stringpool.resourcemap.attrs]
+        prefixes = dict((j, i) for i, j in aml.namespaces.items())
+        prefixes.setdefault('android', AML.ANDROID_NAMESPACE)
+        refs = collections.defaultdict(set)
+        for ref, s in enumerate(strings):
+            refs[s].add(ref)
+        registry = AML.ResourceMapChunk.REGISTRY
+        compiled = []
+        for step in self._steps:
+            namerefs = None
+            if step.name is not None:
+                namerefs = refs.get(step.name)
+                if not namerefs:
+                    return None
+            predicates = []
+            for predicate in step.predicates:
+                nsrefs = None
+                if predicate.prefix is not None:
+                    nsrefs = refs.get(prefixes.get(predicate.prefix))
+                    if not nsrefs:
+                        return None
+                attrrefs = set(refs.get(predicate.name, ()))
+                # Attribute names may be stripped from the pool, the resource map still has their ids.
+                attrid = registry.getattrid(predicate.name)
+                if attrid is not None:
+                    attrrefs.update([i for i, j in enumerate(resourceids) if j == attrid])
+                if not attrrefs:
+                    return None
+                predicates.append((nsrefs, frozenset(attrrefs), valuematcher(predicate.value, strings)))
+            compiled.append((step.descendant, namerefs, predicates))
+        return compiled
+
+    @staticmethod
+    def _matches(buf, bodyoffset, namerefs, predicates):
+        ns, name, attributeStart, attributeSize, attributeCount = parsestruct(buf, 'IIHHH', bodyoffset)
+        if namerefs is not None and name not in namerefs:
+            return False
+        for nsrefs, attrrefs, matches in predicates:
+            offset = bodyoffset + attributeStart
+            for i in range(attributeCount):
+                attrns, attrname, datatype, data = parsestruct(buf, 'II7xBI', offset)
+                if attrname in attrrefs and (nsrefs is None or attrns in nsrefs):
+                    if not matches(datatype, data):
+                        return False
+                    break
+                offset += attributeSize
+            else:
+                return False
+        return True
+
+    def iterselect(self, aml):
+        """
+        Yields the ResXMLTree of every element that matches, reading aml, a fresh AML cursor, to its end.
+        Elements are yielded as they are read, so they can be patched or inserted after right away.
+        """
+        buf = aml.buffer
+        compiled = None
+        # The steps that may match at each depth, 0 being the children of the document.
+        stack = [(0,)]
+        while aml.hasnext():
+            header, body = aml.next()
+            if header.type == ResTypes.RES_XML_START_ELEMENT_TYPE:
+                if compiled is None:
+                    compiled = self.compile(aml) or []
+                    if not compiled:
+                        stack = [()]
+                states = []
+                matched = False
+                for state in stack[-1]:
+                    descendant, namerefs, predicates = compiled[state]
+                    if descendant:
+                        states.append(state)
+                    if Selector._matches(buf, header.bodyoffset, namerefs, predicates):
+                        if state + 1 == len(compiled):
+                            matched = True
+                        else:
+                            states.append(state + 1)
+                stack.append(tuple(sorted(set(states))))
+                if matched:
+                    yield body
+            elif header.type == ResTypes.RES_XML_END_ELEMENT_TYPE:
+                stack.pop()
+
+    def select(self, buffer):
+        """Returns the ResXMLTree of every element that matches in the document, a buffer, path or file descriptor."""
+        return list(self.iterselect(AML(buffer, readonly=True)))
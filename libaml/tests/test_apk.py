@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from libaml.aml import AML, ResTypes
+from libaml.apk import MANIFEST, readentry, rewriteentry
+from libaml.compiler import compilexml
+from libaml.manifest import readmanifest
+
+
+MANIFEST_XML = '''<?xml version="1.0" encoding="utf-8"?>
+<manifest xmlns:android="http://schemas.android.com/apk/res/android" package="com.example"
+          android:versionCode="41" android:versionName="1.4.1">
+  <uses-sdk android:minSdkVersion="21" android:targetSdkVersion="34"/>
+  <application android:label="Example"/>
+</manifest>'''
+
+ENTRIES = [(MANIFEST, zipfile.ZIP_DEFLATED, bytes(compilexml(MANIFEST_XML))),
+           ('classes.dex', zipfile.ZIP_DEFLATED, b'dex\n035\x00' + bytes(range(256)) * 8),
+           ('lib/x86/libexample.so', zipfile.ZIP_STORED, b'\x7fELF' + bytes(1021)),
+           ('res/raw/data.bin', zipfile.ZIP_STORED, bytes(range(7)))]
+
+
+class UnseekableStream(object):
+    """Makes zipfile write every entry with a data descriptor, as it does for streamed archives."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+
+def bumpversion(buf):
+    aml = AML(buf)
+    while aml.hasnext():
+        header, body = aml.next()
+        if header.type == ResTypes.RES_XML_START_ELEMENT_TYPE and body.nodename == 'manifest':
+            body.getattribute('versionCode').patch(42)
+    return None
+
+
+class RewriteEntryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'example.apk')
+        stream = UnseekableStream()
+        with zipfile.ZipFile(stream, 'w') as apk:
+            for name, method, data in ENTRIES:
+                apk.writestr(zipfile.ZipInfo(name), data, compress_type=method)
+        with open(self.path, 'wb') as fp:
+            fp.write(stream.buffer.getvalue())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertvalid(self, path, versioncode=42):
+        with zipfile.ZipFile(path) as apk:
+            self.assertIsNone(apk.testzip())
+            for name, method, data in ENTRIES[1:]:
+                self.assertEqual(apk.read(name), data)
+            self.assertFalse(apk.getinfo(MANIFEST).flag_bits & 0x08)
+        self.assertEqual(readmanifest(readentry(path)).versionCode, versioncode)
+
+    def test_data_descriptors(self):
+        with zipfile.ZipFile(self.path) as apk:
+            self.assertTrue(all([i.flag_bits & 0x08 for i in apk.infolist()]))
+        outpath = os.path.join(self.directory, 'out.apk')
+        rewriteentry(self.path, outpath, bumpversion)
+        self.assertvalid(outpath)
+
+    def test_same_file(self):
+        rewriteentry(self.path, self.path, bumpversion)
+        self.assertvalid(self.path)
+        self.assertEqual(os.listdir(self.directory), ['example.apk'])
+
+    def test_alignment(self):
+        for alignment in (4, 4096):
+            outpath = os.path.join(self.directory, 'out%d.apk' % alignment)
+            rewriteentry(self.path, outpath, lambda buf: bytes(buf) + bytes(3), alignment=alignment)
+            with zipfile.ZipFile(self.path) as apk, zipfile.ZipFile(outpath) as out:
+                self.assertIsNone(out.testzip())
+                self.assertEqual(out.read(MANIFEST), ENTRIES[0][2] + bytes(3))
+                for name, method, data in ENTRIES[1:]:
+                    self.assertEqual((out.getinfo(name).header_offset - apk.getinfo(name).header_offset) % alignment, 0)
+
+    def test_failed_rewrite(self):
+        def fail(buf):
+            raise ValueError('broken')
+
+        with open(self.path, 'rb') as fp:
+            original = fp.read()
+        with self.assertRaises(ValueError):
+            rewriteentry(self.path, self.path, fail)
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(fp.read(), original)
+        self.assertEqual(os.listdir(self.directory), ['example.apk'])
+
+    def test_missing_entry(self):
+        with self.assertRaises(KeyError):
+            rewriteentry(self.path, os.path.join(self.directory, 'out.apk'), bumpversion, name='missing.xml')
+
+
+if __name__ == '__main__':
+    unittest.main()
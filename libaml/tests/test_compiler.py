@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from libaml.aml import AML, Res_value, ResTypes
+from libaml.compiler import compilexml, parsevalue
+
+
+MANIFEST = '<manifest xmlns:android="http://schemas.android.com/apk/res/android" package="com.example" %s/>'
+
+
+def compileattribute(name, value):
+    """Compiles a manifest holding android:name=value, returns its attribute as (dataType, data, text)."""
+    aml = AML(compilexml(MANIFEST % ('android:%s="%s"' % (name, value))), readonly=True)
+    while aml.hasnext():
+        header, body = aml.next()
+        if header.type == ResTypes.RES_XML_START_ELEMENT_TYPE:
+            typedvalue = body.getattribute(name).typedValue
+            return typedvalue.dataType, typedvalue.data, typedvalue.value
+    return None
+
+
+class CompilerTest(unittest.TestCase):
+    def assertroundtrip(self, name, value, datatype):
+        compiled = compileattribute(name, value)
+        self.assertEqual(compiled[:2], (datatype, parsevalue(value)[1]))
+        # The decoded text compiles back to the same value.
+        self.assertEqual(compileattribute(name, compiled[2]), compiled)
+
+    def test_dimensions(self):
+        for value in ('16dp', '1.5sp', '-2px', '0.25in', '12pt', '3mm'):
+            self.assertroundtrip('minWidth', value, Res_value.TYPE_DIMENSION)
+        self.assertEqual(compileattribute('minWidth', '16dp')[1], 16 << 8 | 1)
+
+    def test_fractions(self):
+        for value in ('50%', '25%p', '100%', '12.5%'):
+            self.assertroundtrip('pivotX', value, Res_value.TYPE_FRACTION)
+
+    def test_colors(self):
+        self.assertroundtrip('textColor', '#f0a', Res_value.TYPE_INT_COLOR_RGB4)
+        self.assertroundtrip('textColor', '#8f0a', Res_value.TYPE_INT_COLOR_ARGB4)
+        self.assertroundtrip('textColor', '#ff00aa', Res_value.TYPE_INT_COLOR_RGB8)
+        self.assertroundtrip('textColor', '#80ff00aa', Res_value.TYPE_INT_COLOR_ARGB8)
+        self.assertEqual(compileattribute('textColor', '#f0a')[1], 0xffff00aa)
+        self.assertEqual(compileattribute('textColor', '#8f0a')[1], 0x88ff00aa)
+
+    def test_references(self):
+        self.assertroundtrip('icon', '@7f010000', Res_value.TYPE_REFERENCE)
+        self.assertroundtrip('theme', '?7f010001', Res_value.TYPE_ATTRIBUTE)
+        self.assertEqual(compileattribute('icon', '@null'), (Res_value.TYPE_REFERENCE, 0, '@null'))
+        self.assertEqual(compileattribute('icon', '@empty'), (Res_value.TYPE_NULL, 1, '@empty'))
+
+    def test_references_of_string_attributes(self):
+        self.assertroundtrip('label', '@7f0a0001', Res_value.TYPE_REFERENCE)
+        self.assertEqual(compileattribute('label', '@null')[:2], (Res_value.TYPE_REFERENCE, 0))
+        self.assertEqual(compileattribute('label', '@home')[::2], (Res_value.TYPE_STRING, '@home'))
+
+    def test_untyped_text(self):
+        self.assertEqual(compileattribute('label', 'Example')[::2], (Res_value.TYPE_STRING, 'Example'))
+        with self.assertRaises(NotImplementedError):
+            compileattribute('minWidth', 'wide')
+
+    def test_toxml(self):
+        xml = MANIFEST % 'android:minWidth="1.5sp" android:pivotX="25%p" android:textColor="#80ff00aa" ' \
+                         'android:icon="@7f010000" android:theme="?7f010001" android:label="Example"'
+        compiled = compilexml(xml)
+        recompiled = compilexml(AML(compiled, readonly=True).toxml())
+        self.assertEqual(list(AML(recompiled, readonly=True).iterevents())[1][3],
+                         list(AML(compiled, readonly=True).iterevents())[1][3])
+
+
+if __name__ == '__main__':
+    unittest.main()
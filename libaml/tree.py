@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module Description:
+Read-only tree of a binary XML document built in one pass, for queries that need parents, subtrees or repeated
+lookups. Elements and attributes are rows of parallel arrays holding string refs and raw typed values, so a tree
+costs a few dozen bytes per element instead of a ResXMLTree object graph.
+Element name and attribute name indexes turn queries like Tree.find('activity', exported=True) into lookups.
+"""
+
+import array
+import ctypes
+import struct
+
+from .aml import AML, AttributeColumns, ResChunk, ResTypes, ResXMLTree_attribute, Res_value, mapfile, parsestruct
+
+
+def valuematcher(value, strings):
+    """
+    Returns a test of (dataType, data) for value, which compares the raw value instead of decoding it: None matches
+    anything, bool and int match by data, tuples are (dataType, data) and str matches refs of strings.
+    """
+    if value is None:
+        return lambda datatype, data: True
+    elif type(value) is bool:
+        return lambda datatype, data: datatype == Res_value.TYPE_INT_BOOLEAN and (data != 0) == value
+    elif type(value) is int:
+        data = value & 0xffffffff
+        return lambda datatype, d: Res_value.TYPE_FIRST_INT <= datatype <= Res_value.TYPE_LAST_INT and d == data
+    elif type(value) is tuple:
+        return lambda datatype, data: (datatype, data) == value
+    refs = set([i for i, j in enumerate(strings) if j == value])
+    return lambda datatype, data: datatype == Res_value.TYPE_STRING and data in refs
+
+
+class Tree:
+    def __init__(self, buffer):
+        """buffer is either the document itself or a path or file descriptor to map it from."""
+        buf = memoryview(mapfile(buffer))
+        # element columns, indexed by element in document order
+        self._namespaces = array.array('I')
+        self._names = array.array('I')
+        self._parents = array.array('i')
+        self._ends = array.array('I')
+        self._lines = array.array('I')
+        # the attributes of element i are rows _firstattrs[i] to _firstattrs[i + 1]
+        self._firstattrs = array.array('I')
+        # attribute columns, indexed by attribute row
+        self._attrnamespaces = array.array('I')
+        self._attrnames = array.array('I')
+        self._datatypes = array.array('B')
+        self._data = array.array('I')
+        # string ref -> elements
+        self._byname = {}
+        self._byattr = {}
+        self._strings = []
+        resourceids = array.array('I')
+        records = []
+        rows = 0
+        stack = []
+        root, nul = ResChunk.Header.parsefrom(buf, 0)
+        offset, end = root.headerSize, min(root.chunkSize, len(buf))
+        while offset < end:
+            header, nul = ResChunk.Header.parsefrom(buf, offset, buffer=buf, start=offset)
+            if header.type == ResTypes.RES_XML_START_ELEMENT_TYPE:
+                element = len(self._names)
+                line, = parsestruct(buf, 'I', offset + 8)
+                ns, name, attributeStart, attributeSize, attributeCount = parsestruct(buf, 'IIHHH', header.bodyoffset)
+                self._namespaces.append(ns)
+                self._names.append(name)
+                self._parents.append(stack[-1] if stack else -1)
+                self._ends.append(0)
+                self._lines.append(line)
+                self._firstattrs.append(rows)
+                self._byname.setdefault(name, array.array('I')).append(element)
+                records.append(AttributeColumns.packrecords(buf, header.bodyoffset + attributeStart, attributeCount,
+                                                            attributeSize))
+                rows += attributeCount
+                stack.append(element)
+            elif header.type == ResTypes.RES_XML_END_ELEMENT_TYPE:
+                self._ends[stack.pop()] = len(self._names)
+            elif header.type == ResTypes.RES_STRING_POOL_TYPE:
+                self._strings = list(AML.StringPoolChunk(buf, offset).originalstrings)
+            elif header.type == ResTypes.RES_XML_RESOURCE_MAP_TYPE:
+                resourceids.frombytes(buf[header.bodyoffset:header.nextoffset])
+            offset = header.nextoffset
+        self._firstattrs.append(rows)
+        for ns, name, rawvalue, size, res0, datatype, data in struct.iter_unpack(ResXMLTree_attribute._STRUCT_FORMAT,
+                                                                                 b''.join(records)):
+            self._attrnamespaces.append(ns)
+            self._attrnames.append(name)
+            self._datatypes.append(datatype)
+            self._data.append(data)
+        for element in range(len(self._names)):
+            for row in range(self._firstattrs[element], self._firstattrs[element + 1]):
+                elements = self._byattr.setdefault(self._attrnames[row], array.array('I'))
+                if not elements or elements[-1] != element:
+                    elements.append(element)
+        self._elementrefs = dict((self._strings[i], i) for i in self._byname)
+        # Stripped attribute names are only known by their resource id.
+        self._attrnamesbyref = {}
+        for ref in self._byattr:
+            name = self._strings[ref]
+            if not name and ref < len(resourceids):
+                name = AML.ResourceMapChunk.ATTRS.getname(resourceids[ref]) or name
+            self._attrnamesbyref[ref] = name
+        self._attrrefs = dict((j, i) for i, j in self._attrnamesbyref.items())
+
+    def __len__(self):
+        return len(self._names)
+
+    @property
+    def strings(self):
+        return self._strings
+
+    def name(self, element):
+        return self._strings[self._names[element]]
+
+    def namespace(self, element):
+        ns = self._namespaces[element]
+        return None if ns == AML.NONE_NAMESPACE_REF else self._strings[ns]
+
+    def linenumber(self, element):
+        return self._lines[element]
+
+    def parent(self, element):
+        """Returns the parent of element, or -1 for the root."""
+        return self._parents[element]
+
+    def children(self, element):
+        return [i for i in self.descendants(element) if self._parents[i] == element]
+
+    def descendants(self, element):
+        """Every element below element, in document order."""
+        return range(element + 1, self._ends[element])
+
+    def attributes(self, element):
+        """The attribute rows of element."""
+        return range(self._firstattrs[element], self._firstattrs[element + 1])
+
+    def attrname(self, row):
+        return self._attrnamesbyref[self._attrnames[row]]
+
+    def attrnamespace(self, row):
+        ns = self._attrnamespaces[row]
+        return None if ns == AML.NONE_NAMESPACE_REF else self._strings[ns]
+
+    def getvalue(self, row):
+        """Returns the value of attribute row as str, bool or int, or as a (dataType, data) tuple for other types."""
+        datatype, data = self._datatypes[row], self._data[row]
+        if datatype == Res_value.TYPE_STRING:
+            return self._strings[data]
+        elif datatype == Res_value.TYPE_INT_BOOLEAN:
+            return data != 0
+        elif Res_value.TYPE_FIRST_INT <= datatype <= Res_value.TYPE_LAST_INT:
+            return ctypes.c_int32(data).value if datatype == Res_value.TYPE_INT_DEC else data
+        return datatype, data
+
+    def getattributes(self, element):
+        return dict((self.attrname(i), self.getvalue(i)) for i in self.attributes(element))
+
+    def getattribute(self, element, name):
+        row = self._findattribute(element, self._attrrefs.get(name))
+        return None if row is None else self.getvalue(row)
+
+    def _findattribute(self, element, ref):
+        if ref is not None:
+            for row in self.attributes(element):
+                if self._attrnames[row] == ref:
+                    return row
+        return None
+
+    def find(self, elementname=None, **attributes):
+        """
+        Returns the elements called elementname, or any element without one, that have all the given attributes, in
+        document order. An attribute given as None only has to be present, any other value has to be equal.
+        """
+        indexes = []
+        nameref = self._elementrefs.get(elementname)
+        if elementname is not None:
+            if nameref is None:
+                return []
+            indexes.append(self._byname[nameref])
+        conditions = []
+        for attrname, value in attributes.items():
+            ref = self._attrrefs.get(attrname)
+            if ref is None:
+                return []
+            indexes.append(self._byattr[ref])
+            conditions.append((ref, valuematcher(value, self._strings)))
+        if not indexes:
+            return list(range(len(self._names)))
+        # Only the smallest index is walked, everything else is checked on its elements.
+        result = []
+        for element in min(indexes, key=len):
+            if nameref is not None and self._names[element] != nameref:
+                continue
+            for ref, matches in conditions:
+                row = self._findattribute(element, ref)
+                if row is None or not matches(self._datatypes[row], self._data[row]):
+                    break
+            else:
+                result.append(element)
+        return result
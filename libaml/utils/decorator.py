@@ -4,60 +4,47 @@
 import inspect
 import struct
 
+
 class Struct:
+    """
+    Class decorator describing a fixed-size binary record.
+
+    The decorated class is rebuilt with __slots__ for its fields, and gets parse/parsefrom/create/tobytes/packinto
+    functions generated for its exact layout. Nested fixed-size structs are flattened into a single precompiled
+    struct.Struct, so a record is decoded with one unpack_from call and no intermediate buffer slices.
+    """
+
     def __init__(self, signature, fieldnames):
-        self._signature = signature
+        self._signature = [signature] if type(signature) is str else list(signature)
         self._fieldnames = fieldnames
-        self._structs = Struct.initstructs(signature, fieldnames)
-        self._structsize = Struct.calculatesize(signature)
+        self._fields = Struct.initfields(self._signature, fieldnames)
+        self._structsize = Struct.calculatesize(self._signature)
 
     @staticmethod
-    def initstructs(signature, fieldnames):
+    def initfields(signature, fieldnames):
         nameoffset = 0
-
-        class BySignature:
-            def __init__(self, names, signature):
-                self._signature = signature
-                self._names = names
-                self._size = struct.calcsize(signature)
-
-            def parse(self, _buf, *args, **kwargs):
-                return zip(self._names, struct.unpack(self._signature, _buf[:self._size])), _buf[self._size:]
-
-            def tobytes(self, obj):
-                return struct.pack(self._signature, *[getattr(obj, i) for i in self._names])
-
-        class ByStruct:
-            def __init__(self, name, st):
-                self._name = name
-                self._struct = st
-
-            def parse(self, _buf, *args, **kwargs):
-                obj, nextbuf = self._struct.parse(_buf, *args, **kwargs)
-                return [(self._name, obj)], nextbuf
-
-            def tobytes(self, obj):
-                st = getattr(obj, self._name)
-                return st.tobytes()
-
-        structs = []
-        if type(signature) is str:
-            structs.append(BySignature(fieldnames, signature))
-        else:
-            for sig in signature:
-                if type(sig) is str:
-                    names = fieldnames[nameoffset:nameoffset+len(sig)]
-                    nameoffset += len(names)
-                    structs.append(BySignature(names, sig))
-                else:
-                    name = fieldnames[nameoffset]
-                    nameoffset += 1
-                    structs.append(ByStruct(name, sig))
-        return structs
+        fields = []
+        for sig in signature:
+            if type(sig) is str:
+                count = len(struct.unpack(sig, bytes(struct.calcsize(sig))))
+                fields.append((sig, fieldnames[nameoffset:nameoffset + count]))
+                nameoffset += count
+            else:
+                fields.append((sig, fieldnames[nameoffset]))
+                nameoffset += 1
+        return fields
 
     @staticmethod
     def calculatesize(signature):
-        return sum([struct.calcsize(i) if type(i) is str else i.size for i in signature])
+        return sum([struct.calcsize(i) if type(i) is str else i._STRUCT_SIZE for i in signature])
+
+    @staticmethod
+    def flatformat(signature):
+        formats = [i if type(i) is str else i._STRUCT_FORMAT for i in signature]
+        if None in formats:
+            return None
+        fmt = ''.join(formats)
+        return fmt if struct.calcsize(fmt) == Struct.calculatesize(signature) else None
 
     @staticmethod
     def override(cls, name, attr):
@@ -66,7 +53,124 @@ class Struct:
         else:
             setattr(cls, name, attr)
 
+    @staticmethod
+    def addslots(cls, names):
+        declared = cls.__dict__.get('__slots__', ())
+        declared = (declared,) if type(declared) is str else tuple(declared)
+        namespace = dict(cls.__dict__)
+        for i in declared + ('__dict__', '__weakref__'):
+            namespace.pop(i, None)
+        namespace['__slots__'] = declared + tuple(i for i in names if i not in declared and not hasattr(cls, i))
+        return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+    class CodeBuilder:
+        """Generates the straight-line parse/pack functions of a decorated class."""
+
+        def __init__(self):
+            self.lines = []
+            self.scope = {}
+            self._counter = 0
+
+        def name(self, prefix, value):
+            self._counter += 1
+            name = '%s%d' % (prefix, self._counter)
+            self.scope[name] = value
+            return name
+
+        def compile(self, funcname):
+            source = '\n'.join(self.lines)
+            exec(compile(source, '<Struct %s>' % funcname, 'exec'), self.scope)
+            return self.scope[funcname]
+
+        def construct(self, cls, var):
+            clsname = self.name('cls', cls)
+            if cls._INIT_KWARGS:
+                initkwargs = self.name('initkwargs', cls._INIT_KWARGS)
+                self.lines.append('    %s = %s(*args, **dict([(k, v) for k, v in kwargs.items() if k in %s]))'
+                                  % (var, clsname, initkwargs))
+            else:
+                self.lines.append('    %s = %s(*args)' % (var, clsname))
+
+        def assignvalues(self, cls, var, index):
+            """Builds cls from the flat values tuple 'v' starting at index, returns the next index."""
+            self.construct(cls, var)
+            for sig, names in cls._STRUCT_FIELDS:
+                if type(sig) is str:
+                    for name in names:
+                        self.lines.append('    %s.%s = v[%d]' % (var, name, index))
+                        index += 1
+                else:
+                    nested = '%s_%s' % (var, names)
+                    index = self.assignvalues(sig, nested, index)
+                    self.lines.append('    %s.%s = %s' % (var, names, nested))
+            return index
+
+        def flatvalues(self, cls, var):
+            """Returns the expressions of every flat value of cls, or None if a nested struct packs itself."""
+            values = []
+            for sig, names in cls._STRUCT_FIELDS:
+                if type(sig) is str:
+                    values.extend('%s.%s' % (var, name) for name in names)
+                elif sig.__dict__.get('tobytes') is not sig._STRUCT_TOBYTES:
+                    return None
+                else:
+                    nested = self.flatvalues(sig, '%s.%s' % (var, names))
+                    if nested is None:
+                        return None
+                    values.extend(nested)
+            return values
+
+    def buildparse(self, cls):
+        builder = Struct.CodeBuilder()
+        builder.lines.append('def parsefrom(buf, offset, *args, **kwargs):')
+        if cls._STRUCT is not None:
+            builder.lines.append('    v = %s(buf, offset)' % builder.name('unpack', cls._STRUCT.unpack_from))
+            builder.assignvalues(cls, 'obj', 0)
+        else:
+            builder.construct(cls, 'obj')
+            offset = 0
+            for sig, names in self._fields:
+                if type(sig) is str:
+                    unpack = builder.name('unpack', struct.Struct(sig).unpack_from)
+                    builder.lines.append('    v = %s(buf, offset + %d)' % (unpack, offset))
+                    for i, name in enumerate(names):
+                        builder.lines.append('    obj.%s = v[%d]' % (name, i))
+                    offset += struct.calcsize(sig)
+                else:
+                    nested = builder.name('cls', sig)
+                    builder.lines.append('    obj.%s, nul = %s.parsefrom(buf, offset + %d, *args, **kwargs)'
+                                         % (names, nested, offset))
+                    offset += sig._STRUCT_SIZE
+        builder.lines.append('    return obj, offset + %d' % self._structsize)
+        return builder.compile('parsefrom')
+
+    def buildpack(self, cls):
+        builder = Struct.CodeBuilder()
+        values = builder.flatvalues(cls, 'obj') if cls._STRUCT is not None else None
+        builder.lines.append('def tobytes(obj):')
+        if values is not None:
+            builder.lines.append('    return %s(%s)' % (builder.name('pack', cls._STRUCT.pack), ', '.join(values)))
+        else:
+            pieces = []
+            for sig, names in self._fields:
+                if type(sig) is str:
+                    pack = builder.name('pack', struct.Struct(sig).pack)
+                    pieces.append('%s(%s)' % (pack, ', '.join('obj.%s' % name for name in names)))
+                else:
+                    pieces.append('obj.%s.tobytes()' % names)
+            builder.lines.append("    return b''.join([%s])" % ', '.join(pieces))
+        builder.lines.append('def packinto(obj, buf, offset):')
+        if values is not None:
+            builder.lines.append('    %s(buf, offset, %s)'
+                                 % (builder.name('packinto', cls._STRUCT.pack_into), ', '.join(values)))
+        else:
+            builder.lines.append('    buf[offset:offset + %d] = tobytes(obj)' % self._structsize)
+        return builder.compile('tobytes'), builder.scope['packinto']
+
     def __call__(self, cls):
+        cls = Struct.addslots(cls, [name for sig, names in self._fields
+                                    for name in ([names] if type(names) is str else names)])
+
         def getinitargs(kwargs):
             return dict([(k, v) for k, v in kwargs.items() if k in cls._INIT_KWARGS])
 
@@ -76,25 +180,26 @@ class Struct:
                 setattr(s, self._fieldnames[i], j)
             return s
 
-        def tobytes(s):
-            bos = [i.tobytes(s) for i in self._structs]
-            return b''.join(bos)
-
         def parse(buf, *args, **kwargs):
-            obj = cls(*args, **getinitargs(kwargs))
-            for i in self._structs:
-                items, buf = i.parse(buf, *args, **kwargs)
-                for k, v in items:
-                    setattr(obj, k, v)
-            return obj, buf
+            obj, offset = parsefrom(buf, 0, *args, **kwargs)
+            return obj, buf[offset:]
 
         try:
-            cls._INIT_KWARGS = set(inspect.getargspec(cls.__init__)[0][1:])
+            cls._INIT_KWARGS = set(inspect.getfullargspec(cls.__init__)[0][1:])
         except (TypeError, AttributeError):
             cls._INIT_KWARGS = set([])
+        cls._STRUCT_FIELDS = self._fields
+        cls._STRUCT_SIZE = self._structsize
+        cls._STRUCT_FORMAT = Struct.flatformat(self._signature)
+        cls._STRUCT = None if cls._STRUCT_FORMAT is None else struct.Struct(cls._STRUCT_FORMAT)
+        parsefrom = self.buildparse(cls)
+        tobytes, packinto = self.buildpack(cls)
+        cls._STRUCT_TOBYTES = tobytes
         Struct.override(cls, 'tobytes', tobytes)
+        Struct.override(cls, 'packinto', packinto)
         Struct.override(cls, 'create', staticmethod(create))
         Struct.override(cls, 'parse', staticmethod(parse))
+        Struct.override(cls, 'parsefrom', staticmethod(parsefrom))
         Struct.override(cls, 'size', self._structsize)
         return cls
 
@@ -115,4 +220,4 @@ if __name__ == '__main__':
     ss = MyAnotherStruct.create(1, 2, s1, 3, 4, 5)
     buf = ss.tobytes()
     ss1, p = MyAnotherStruct.parse(buf)
-    print(str(ss1))
\ No newline at end of file
+    print(str(ss1))
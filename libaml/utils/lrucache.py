@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+
+
+class LRUCache:
+    """
+    Mapping that keeps at most maxsize items, dropping the least recently used one first.
+    With a sizeof function, maxsize bounds the sum of sizeof(value) instead of the number of items.
+    """
+
+    def __init__(self, maxsize=1024, sizeof=None):
+        self._maxsize = maxsize
+        self._sizeof = sizeof
+        self._size = 0
+        self._items = collections.OrderedDict()
+
+    def _itemsize(self, value):
+        return 1 if self._sizeof is None else self._sizeof(value)
+
+    def get(self, key, default=None):
+        if key not in self._items:
+            return default
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, key):
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def __setitem__(self, key, value):
+        if key in self._items:
+            self._size -= self._itemsize(self._items.pop(key))
+        self._items[key] = value
+        self._size += self._itemsize(value)
+        while self._size > self._maxsize and len(self._items) > 1:
+            key, value = self._items.popitem(last=False)
+            self._size -= self._itemsize(value)
+
+    def __delitem__(self, key):
+        self._size -= self._itemsize(self._items.pop(key))
+
+    def clear(self):
+        self._items.clear()
+        self._size = 0
+
+    @property
+    def size(self):
+        return self._size